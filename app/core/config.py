@@ -10,4 +10,62 @@ class Settings(BaseSettings):
     admin_password: str
     pixiv_refresh_token: str # Добавили
 
-settings = Settings()
\ No newline at end of file
+    # Бюджет памяти кэша разобранных файлов-источников (в мегабайтах);
+    # занимаемая память оценивается как размер файла x PARSED_SIZE_FACTOR (см. file_cache.py)
+    file_cache_max_mb: int = 256
+    # Бюджет диска для скачанных с Pixiv оригиналов картинок (в мегабайтах)
+    image_store_max_mb: int = 2048
+    # Сколько секунд не повторять неудачную загрузку или подготовку картинки
+    image_store_failure_ttl: int = 60
+    # Подготовка картинок для Telegram: длинная сторона (px), качество, формат (JPEG/WEBP), число процессов
+    image_prep_max_side: int = 2560
+    image_prep_quality: int = 87
+    image_prep_format: str = "JPEG"
+    image_prep_workers: int = 2
+    # Многостраничные посты отправляются альбомом (не больше 10 картинок - лимит Telegram)
+    album_mode_enabled: bool = True
+
+    # Кэш страниц поиска Pixiv: время жизни, период stale-while-revalidate (в секундах) и число страниц
+    pixiv_search_cache_ttl: int = 600
+    pixiv_search_cache_stale: int = 1800
+    pixiv_search_cache_size: int = 1024
+    # Ограничение запросов к API Pixiv: средняя скорость (запросов в секунду), запас на всплеск,
+    # число одновременных запросов, таймаут запроса и пауза после ответа "Rate Limit" (в секундах)
+    pixiv_rate_per_sec: float = 2.0
+    pixiv_rate_burst: int = 5
+    pixiv_max_concurrency: int = 4
+    pixiv_request_timeout: int = 15
+    pixiv_rate_limit_cooldown: int = 30
+    # Размер пула HTTP-соединений (keep-alive) к Pixiv
+    pixiv_http_pool_size: int = 20
+    # За сколько секунд до истечения access token обновлять его в фоне
+    pixiv_token_refresh_margin: int = 300
+    # За сколько постов до конца страницы поиска начинать загрузку следующей
+    pixiv_prefetch_threshold: int = 5
+
+    # Отложенная запись оценок и прогресса: включение, период сброса (мс) и размер пачки
+    write_behind_enabled: bool = False
+    write_behind_flush_ms: int = 200
+    write_behind_batch_size: int = 500
+    # Сколько записей прогресса (пользователь, источник) держать в памяти
+    progress_cache_size: int = 10000
+    # Кэш пользователей и их авторизации: время жизни записи (сек) и размер
+    user_cache_ttl: int = 300
+    user_cache_size: int = 10000
+    # Сколько file_id картинок Telegram держать в памяти (в БД хранятся все)
+    telegram_file_id_cache_size: int = 50000
+    # Сколько id оцененных картинок (по всем пользователям) держать в памяти, 4 байта на id
+    rated_index_max_ids: int = 2_000_000
+
+    # Профиль SQLite
+    sqlite_synchronous: str = "NORMAL"
+    sqlite_mmap_size_mb: int = 256
+    sqlite_cache_size_mb: int = 64
+    sqlite_busy_timeout_ms: int = 5000
+    sqlite_read_pool_size: int = 4
+    # Периодическое обслуживание БД (в секундах)
+    sqlite_checkpoint_interval: int = 300
+    sqlite_optimize_interval: int = 3600
+    sqlite_analyze_interval: int = 86400
+
+settings = Settings()
@@ -8,11 +8,15 @@ from aiogram.types import BotCommand
 from aiogram.fsm.storage.memory import MemoryStorage
 
 from .config import settings
-from app.database.engine import create_db_and_tables, async_session_factory
-from app.database.middleware import DbSessionMiddleware
-from app.handlers import common, authorization, user_content, evaluation
+from app.database.engine import create_db_and_tables, async_session_factory, read_session_factory
+from app.database.maintenance import storage_maintenance
+from app.database.middleware import DbSessionMiddleware, UserMiddleware
+from app.database.write_behind import write_behind
+from app.handlers import common, authorization, user_content, evaluation, stats
 from app.handlers.debug import debug_router
 from app.utils.pixiv import pixiv_client
+from app.utils.image_prep import image_preparer
+from app.utils.ingestion import resume_pending_ingestions
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
@@ -24,6 +28,11 @@ async def on_startup(bot: Bot):
     await create_db_and_tables()
     print("Аутентификация в Pixiv...")
     await pixiv_client.login()
+    pixiv_client.start_token_refresh()
+    print("Индексация загруженных файлов...")
+    await resume_pending_ingestions(bot)
+    write_behind.start()
+    storage_maintenance.start()
 
     # Установка команд меню
     commands = [
@@ -33,22 +42,35 @@ async def on_startup(bot: Bot):
     print("Бот запущен и готов к работе!")
 
 
+async def on_shutdown(bot: Bot):
+    """Выполняется при остановке бота."""
+    print("Сохранение отложенных оценок...")
+    await write_behind.stop()
+    await storage_maintenance.stop()
+    await pixiv_client.close()
+    image_preparer.shutdown()
+
+
 async def main():
     bot = Bot(token=settings.bot_token)
     storage = MemoryStorage()
     dp = Dispatcher(storage=storage)
-    dp.update.outer_middleware(DbSessionMiddleware(session_pool=async_session_factory))
+    dp.update.outer_middleware(DbSessionMiddleware(session_pool=async_session_factory,
+                                                  read_session_pool=read_session_factory))
+    dp.update.outer_middleware(UserMiddleware())
 
     # Регистрируем роутеры
     dp.include_router(common.router)
     dp.include_router(authorization.router)
     dp.include_router(user_content.router)
     dp.include_router(evaluation.router)
+    dp.include_router(stats.router)
 
     dp.include_router(debug_router)
 
-    # Регистрируем хук на запуск
+    # Регистрируем хуки на запуск и остановку
     dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
 
     # Запускаем бота
     await bot.delete_webhook(drop_pending_updates=True)
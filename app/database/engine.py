@@ -1,6 +1,11 @@
 import os
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from app.core.config import settings
 from .models import Base
+from .migrations import run_migrations
 
 # Путь к папке с данными и файлу БД
 DATA_DIR = "data"
@@ -13,18 +18,61 @@ os.makedirs(DATA_DIR, exist_ok=True)
 # URL для асинхронного подключения к SQLite
 DATABASE_URL = f"sqlite+aiosqlite:///{DB_PATH}"
 
+
+def sqlite_pragmas(read_only: bool = False) -> list:
+    """PRAGMA, которые выполняются на каждом новом соединении."""
+    pragmas = [
+        f"PRAGMA synchronous={settings.sqlite_synchronous}",
+        f"PRAGMA mmap_size={settings.sqlite_mmap_size_mb * 1024 * 1024}",
+        # Отрицательное значение - размер в КиБ, а не в страницах
+        f"PRAGMA cache_size={-settings.sqlite_cache_size_mb * 1024}",
+        f"PRAGMA busy_timeout={settings.sqlite_busy_timeout_ms}",
+        "PRAGMA temp_store=MEMORY",
+    ]
+    if read_only:
+        pragmas.append("PRAGMA query_only=ON")
+    else:
+        # WAL позволяет читателям не блокировать запись и наоборот
+        pragmas.insert(0, "PRAGMA journal_mode=WAL")
+    return pragmas
+
+
+def make_engine(database_url: str, read_only: bool = False, **kwargs) -> AsyncEngine:
+    """
+    Создает движок с профилем производительности SQLite.
+    Соединения переиспользуются пулом, поэтому PRAGMA и прогретый кэш страниц живут дольше одного запроса.
+    """
+    kwargs.setdefault('poolclass', AsyncAdaptedQueuePool)
+    new_engine = create_async_engine(database_url, **kwargs)
+    statements = sqlite_pragmas(read_only)
+
+    @event.listens_for(new_engine.sync_engine, "connect")
+    def _apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+    return new_engine
+
+
 # Создаем асинхронный движок
-engine = create_async_engine(DATABASE_URL, echo=False) # echo=True для дебага SQL запросов
+engine = make_engine(DATABASE_URL, echo=False) # echo=True для дебага SQL запросов
+
+# Отдельный пул только для чтения: экспорт и меню не конкурируют с записью оценок
+read_engine = make_engine(DATABASE_URL, read_only=True, pool_size=settings.sqlite_read_pool_size)
 
 # Создаем фабрику асинхронных сессий
 async_session_factory = async_sessionmaker(engine, expire_on_commit=False)
+read_session_factory = async_sessionmaker(read_engine, expire_on_commit=False)
 
 async def create_db_and_tables():
-    """Создает все таблицы в базе данных."""
+    """Создает недостающие таблицы и обновляет схему существующей БД миграциями."""
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await run_migrations(conn)
 
 async def get_async_session() -> AsyncSession:
     """Зависимость для получения асинхронной сессии."""
     async with async_session_factory() as session:
-        yield session
\ No newline at end of file
+        yield session
@@ -0,0 +1,58 @@
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from app.core.config import settings
+from app.utils.metrics import register_metrics
+
+MISSING = object()
+
+
+class TelegramFileIdCache:
+    """
+    Память перед столбцом artworks.telegram_file_id: artwork_id -> file_id (или None,
+    если картинка еще ни разу не отправлялась). Ограничена по числу записей, вытеснение по LRU.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, Optional[str]]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale_file_ids = 0
+        # Способ, которым фото в итоге было отправлено: 'file_id', 'prepared' или 'url'
+        self.sends: Dict[str, int] = {}
+
+    def get(self, artwork_id: int) -> Any:
+        value = self._entries.get(artwork_id, MISSING)
+        if value is MISSING:
+            self.misses += 1
+            return MISSING
+        self.hits += 1
+        self._entries.move_to_end(artwork_id)
+        return value
+
+    def put(self, artwork_id: int, file_id: Optional[str]):
+        self._entries[artwork_id] = file_id
+        self._entries.move_to_end(artwork_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def record_stale(self):
+        self.stale_file_ids += 1
+
+    def record_send(self, kind: str):
+        self.sends[kind] = self.sends.get(kind, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_file_ids': self.stale_file_ids,
+            **{f'sent_by_{kind}': count for kind, count in self.sends.items()},
+        }
+
+
+file_id_cache = TelegramFileIdCache(settings.telegram_file_id_cache_size)
+register_metrics('telegram_file_ids', file_id_cache.stats)
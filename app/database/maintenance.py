@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.core.config import settings
+from app.utils.metrics import register_metrics
+from .engine import engine
+
+logger = logging.getLogger(__name__)
+
+
+class StorageMaintenance:
+    """
+    Фоновое обслуживание SQLite: регулярные checkpoint-ы WAL,
+    PRAGMA optimize и полный ANALYZE по расписанию.
+    """
+
+    def __init__(self, db_engine: AsyncEngine, checkpoint_interval: float,
+                 optimize_interval: float, analyze_interval: float):
+        self.engine = db_engine
+        self.checkpoint_interval = checkpoint_interval
+        self.optimize_interval = optimize_interval
+        self.analyze_interval = analyze_interval
+        self._task: Optional[asyncio.Task] = None
+
+        self.checkpoints = 0
+        self.last_checkpoint_pages = 0
+        self.optimizes = 0
+        self.analyzes = 0
+
+    async def checkpoint(self):
+        """Переносит WAL в основной файл, не блокируя читателей и писателей (PASSIVE)."""
+        async with self.engine.connect() as conn:
+            result = await conn.execute(text("PRAGMA wal_checkpoint(PASSIVE)"))
+            busy, log_pages, checkpointed = result.one()
+        self.checkpoints += 1
+        self.last_checkpoint_pages = checkpointed
+        logger.debug(f"WAL checkpoint: busy={busy}, log={log_pages}, checkpointed={checkpointed}")
+
+    async def optimize(self):
+        async with self.engine.connect() as conn:
+            await conn.execute(text("PRAGMA optimize"))
+        self.optimizes += 1
+
+    async def analyze(self):
+        async with self.engine.connect() as conn:
+            await conn.execute(text("ANALYZE"))
+            await conn.commit()
+        self.analyzes += 1
+        logger.info("ANALYZE выполнен.")
+
+    async def _run(self):
+        last_optimize = last_analyze = time.monotonic()
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                await self.checkpoint()
+                now = time.monotonic()
+                if now - last_analyze >= self.analyze_interval:
+                    await self.analyze()
+                    last_analyze = last_optimize = now
+                elif now - last_optimize >= self.optimize_interval:
+                    await self.optimize()
+                    last_optimize = now
+            except Exception:
+                logger.error("Ошибка обслуживания БД.", exc_info=True)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # Перед выходом еще раз оптимизируем статистику, как рекомендует документация SQLite
+        await self.optimize()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'checkpoints': self.checkpoints,
+            'last_checkpoint_pages': self.last_checkpoint_pages,
+            'optimizes': self.optimizes,
+            'analyzes': self.analyzes,
+        }
+
+
+storage_maintenance = StorageMaintenance(
+    engine,
+    checkpoint_interval=settings.sqlite_checkpoint_interval,
+    optimize_interval=settings.sqlite_optimize_interval,
+    analyze_interval=settings.sqlite_analyze_interval,
+)
+register_metrics('sqlite_maintenance', storage_maintenance.stats)
@@ -1,16 +1,81 @@
-from typing import Callable, Dict, Any, Awaitable
+import time
+from typing import Callable, Dict, Any, Awaitable, Optional
 
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
-from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session
+
+from app.utils.metrics import register_metrics
+from .requests import get_user_snapshot
+
+# Ключ в session.info: когда сессия начала транзакцию (и заняла соединение из пула)
+_BEGUN_AT_KEY = 'begun_at'
+
+
+@event.listens_for(Session, 'after_begin')
+def _remember_begin(session: Session, transaction, connection):
+    session.info.setdefault(_BEGUN_AT_KEY, time.perf_counter())
+
+
+class LazySession:
+    """
+    Ленивая обертка над AsyncSession: сама сессия создается при первом обращении
+    к любому ее атрибуту (execute, add, get...). Соединение из пула, как и у обычной
+    сессии, занимается только при первом запросе.
+    """
+    __slots__ = ('_factory', '_session')
+
+    def __init__(self, factory: async_sessionmaker):
+        self._factory = factory
+        self._session: Optional[AsyncSession] = None
+
+    @property
+    def is_used(self) -> bool:
+        return self._session is not None
+
+    def __getattr__(self, name: str):
+        if self._session is None:
+            self._session = self._factory()
+        return getattr(self._session, name)
+
+    async def commit(self):
+        """Фиксирует изменения, если сессия создавалась; неиспользованную сессию не создает."""
+        if self._session is not None:
+            await self._session.commit()
+
+    async def release(self) -> Optional[float]:
+        """Закрывает сессию, если она создавалась. Возвращает, сколько секунд было занято соединение."""
+        if self._session is None:
+            return None
+        await self._session.close()
+        begun_at = self._session.info.pop(_BEGUN_AT_KEY, None)
+        return time.perf_counter() - begun_at if begun_at is not None else None
 
 
 class DbSessionMiddleware(BaseMiddleware):
     """
     Middleware для передачи сессии SQLAlchemy в хендлеры.
+    Одно обновление - одна транзакция: commit после успешной обработки, rollback при ошибке.
+    Хендлер, который после записи идет в сеть (Telegram, Pixiv), фиксирует изменения сам через
+    session.commit() до первого запроса: иначе блокировка записи SQLite держится, пока идет I/O,
+    и параллельные записи других обновлений падают с "database is locked".
+    Для тяжелых чтений (экспорт, меню) дополнительно передается read_session из отдельного пула.
+    Обе сессии ленивые: обновление, которое не обращается к БД, ничего не стоит пулу.
     """
-    def __init__(self, session_pool: async_sessionmaker):
+    def __init__(self, session_pool: async_sessionmaker, read_session_pool: Optional[async_sessionmaker] = None):
         self.session_pool = session_pool
+        self.read_session_pool = read_session_pool
+
+        self.updates = 0
+        self.updates_without_db = 0
+        self.write_sessions = 0
+        self.read_sessions = 0
+        self.hold_seconds_total = 0.0
+        self.hold_seconds_max = 0.0
+        self.holds = 0
+        register_metrics('db_sessions', self.stats)
 
     async def __call__(
         self,
@@ -18,8 +83,72 @@ class DbSessionMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: Dict[str, Any]
     ) -> Any:
-        # Создаем сессию из пула и передаем ее в данные события
-        async with self.session_pool() as session:
-            data['session'] = session
-            # Вызываем следующий обработчик в цепочке, передавая ему обновленные данные
-            return await handler(event, data)
\ No newline at end of file
+        session = LazySession(self.session_pool)
+        read_session = LazySession(self.read_session_pool) if self.read_session_pool is not None else session
+        data['session'] = session
+        data['read_session'] = read_session
+
+        try:
+            try:
+                # Вызываем следующий обработчик в цепочке, передавая ему обновленные данные
+                result = await handler(event, data)
+            except Exception:
+                if session.is_used:
+                    await session.rollback()
+                raise
+            # Все изменения за обновление (оценка, прогресс, новые арты) фиксируются одним commit
+            if session.is_used:
+                await session.commit()
+            return result
+        finally:
+            self._record(session, read_session)
+            self._record_hold(await session.release())
+            if read_session is not session:
+                self._record_hold(await read_session.release())
+
+    def _record(self, session: LazySession, read_session: LazySession):
+        self.updates += 1
+        self.write_sessions += session.is_used
+        if read_session is not session:
+            self.read_sessions += read_session.is_used
+        if not session.is_used and not read_session.is_used:
+            self.updates_without_db += 1
+
+    def _record_hold(self, seconds: Optional[float]):
+        if seconds is None:
+            return
+        self.holds += 1
+        self.hold_seconds_total += seconds
+        self.hold_seconds_max = max(self.hold_seconds_max, seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'updates': self.updates,
+            'updates_without_db': self.updates_without_db,
+            'write_sessions': self.write_sessions,
+            'read_sessions': self.read_sessions,
+            'hold_ms_avg': self.hold_seconds_total / self.holds * 1000 if self.holds else 0.0,
+            'hold_ms_max': self.hold_seconds_max * 1000,
+        }
+
+
+class UserMiddleware(BaseMiddleware):
+    """
+    Передает в хендлеры и фильтры снимок текущего пользователя (data['user']).
+    Снимок берется из кэша, поэтому обычное обновление не обращается к таблице users.
+    Регистрируется после DbSessionMiddleware: ему нужна session.
+    """
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        from_user = data.get('event_from_user')
+        if from_user is None:
+            data['user'] = None
+        else:
+            data['user'] = await get_user_snapshot(data['session'], from_user.id, from_user.username)
+            # Новый пользователь записывается сразу, чтобы не держать блокировку записи на время хендлера
+            await data['session'].commit()
+        return await handler(event, data)
@@ -0,0 +1,69 @@
+import logging
+from typing import Awaitable, Callable, List, Tuple, Union
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from .scores import rebuild_score_aggregates
+
+logger = logging.getLogger(__name__)
+
+# Шаг миграции - SQL-строка или корутина, получающая соединение
+Step = Union[str, Callable[[AsyncConnection], Awaitable[None]]]
+
+# Версии схемы по порядку. Уже выпущенные миграции не меняем - только добавляем новые.
+# Шаги должны быть идемпотентными: на новой БД таблицы и индексы уже созданы create_all.
+MIGRATIONS: List[Tuple[int, str, List[Step]]] = [
+    (1, "Составные индексы для выборок источников и экспорта", [
+        "CREATE INDEX IF NOT EXISTS ix_sources_owner_type_active ON sources (owner_id, source_type, is_active)",
+        "CREATE INDEX IF NOT EXISTS ix_sources_type_active_name ON sources (source_type, is_active, name)",
+        "CREATE INDEX IF NOT EXISTS ix_ratings_user_created ON ratings (user_id, created_at)",
+    ]),
+    (2, "Индекс для инкрементального экспорта оценок пользователя", [
+        "CREATE INDEX IF NOT EXISTS ix_ratings_user_rating ON ratings (user_id, rating_id)",
+    ]),
+    # Таблицы агрегатов создает create_all, здесь только заполняем их по уже имеющимся оценкам
+    (3, "Агрегаты оценок по картинкам и источникам", [
+        rebuild_score_aggregates,
+    ]),
+    (4, "file_id Telegram для картинок", [
+        lambda conn: add_column_if_missing(conn, 'artworks', 'telegram_file_id', 'VARCHAR'),
+    ]),
+    # Раньше прогресс запросов хранил смещение в выдаче Pixiv, а не номер поста в снимке.
+    # Сопоставить их без повторного поиска нельзя, поэтому начинаем снимок с начала:
+    # уже оцененные арты пропускаются при поиске следующего.
+    (5, "Сброс прогресса запросов под снимки выдачи", [
+        "UPDATE user_progress SET last_post_index = 0, last_image_index = 0 "
+        "WHERE source_id IN (SELECT source_id FROM sources WHERE source_type = 'query')",
+    ]),
+]
+
+
+async def add_column_if_missing(conn: AsyncConnection, table: str, column: str, ddl_type: str):
+    """ALTER TABLE ADD COLUMN в SQLite не поддерживает IF NOT EXISTS, поэтому сначала смотрим table_info."""
+    result = await conn.execute(text(f"PRAGMA table_info({table})"))
+    if column not in {row[1] for row in result}:
+        await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+
+
+async def get_schema_version(conn: AsyncConnection) -> int:
+    """Версия схемы хранится в заголовке файла SQLite (PRAGMA user_version)."""
+    result = await conn.execute(text("PRAGMA user_version"))
+    return result.scalar_one()
+
+
+async def run_migrations(conn: AsyncConnection):
+    """Применяет все миграции новее текущей версии схемы. Каждая миграция - в той же транзакции, что и ее версия."""
+    current = await get_schema_version(conn)
+    for version, description, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info(f"Применяю миграцию {version}: {description}")
+        for step in steps:
+            if isinstance(step, str):
+                await conn.execute(text(step))
+            else:
+                await step(conn)
+        # PRAGMA не поддерживает параметры, version - число из кода, а не из ввода
+        await conn.execute(text(f"PRAGMA user_version = {int(version)}"))
+        current = version
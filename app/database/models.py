@@ -1,5 +1,5 @@
 from sqlalchemy import (BigInteger, Boolean, Column, ForeignKey, Integer,
-                        String, JSON, DateTime, UniqueConstraint)
+                        String, JSON, DateTime, UniqueConstraint, Index)
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy.sql import func
 
@@ -33,6 +33,8 @@ class Artwork(Base):
     author = Column(String)
     url = Column(String)
     other_data = Column(JSON)
+    # file_id фото, уже загруженного в Telegram: повторная отправка не требует скачивания с Pixiv
+    telegram_file_id = Column(String, nullable=True)
 
     # Гарантируем, что пара (ID поста, индекс картинки) будет уникальной
     __table_args__ = (UniqueConstraint('pixiv_id', 'image_index', name='_pixiv_id_image_index_uc'),)
@@ -51,6 +53,12 @@ class Source(Base):
     ratings = relationship("Rating", back_populates="source")
     progress = relationship("UserProgress", back_populates="source")
 
+    # Индексы под выборки "мои файлы/запросы" и "все активные файлы" (см. migrations.py)
+    __table_args__ = (
+        Index('ix_sources_owner_type_active', 'owner_id', 'source_type', 'is_active'),
+        Index('ix_sources_type_active_name', 'source_type', 'is_active', 'name'),
+    )
+
 
 class Rating(Base):
     __tablename__ = 'ratings'
@@ -69,7 +77,24 @@ class Rating(Base):
     source = relationship("Source", back_populates="ratings")
 
     # Уникальность оценки теперь на связку (пользователь, наша уникальная картинка)
-    __table_args__ = (UniqueConstraint('user_id', 'artwork_id', name='_user_artwork_uc'),)
+    __table_args__ = (
+        UniqueConstraint('user_id', 'artwork_id', name='_user_artwork_uc'),
+        # Экспорт сортирует оценки по пользователю и дате
+        Index('ix_ratings_user_created', 'user_id', 'created_at'),
+        # Инкрементальный экспорт оценок пользователя: диапазон по rating_id
+        Index('ix_ratings_user_rating', 'user_id', 'rating_id'),
+    )
+
+
+class SourceImage(Base):
+    """Проиндексированная картинка файла-источника: позиция в файле -> уже созданный Artwork."""
+    __tablename__ = 'source_images'
+    source_id = Column(Integer, ForeignKey('sources.source_id'), primary_key=True)
+    post_index = Column(Integer, primary_key=True)
+    image_index = Column(Integer, primary_key=True)
+    artwork_id = Column(Integer, ForeignKey('artworks.id'), nullable=False)
+
+    artwork = relationship("Artwork")
 
 
 class UserProgress(Base):
@@ -82,4 +107,69 @@ class UserProgress(Base):
     last_image_index = Column(Integer, default=0)
 
     user = relationship("User", back_populates="progress")
-    source = relationship("Source", back_populates="progress")
\ No newline at end of file
+    source = relationship("Source", back_populates="progress")
+
+class ExportWatermark(Base):
+    """До какой оценки (rating_id) запросивший уже получил экспорт по каждой цели."""
+    __tablename__ = 'export_watermarks'
+    requester_id = Column(BigInteger, ForeignKey('users.user_id'), primary_key=True)
+    # 'all' или 'user:<id>'
+    target = Column(String, primary_key=True)
+    last_rating_id = Column(Integer, nullable=False)
+    exported_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+# Оценки ставятся по шкале 1..10, по столбцу гистограммы на каждое значение
+SCORE_VALUES = range(1, 11)
+
+
+class ScoreAggregateMixin:
+    """
+    Агрегаты оценок, которые обновляются инкрементально вместе с добавлением оценки:
+    число, сумма и сумма квадратов (для среднего и дисперсии) и гистограмма h1..h10.
+    """
+    count = Column(Integer, default=0, nullable=False)
+    total = Column(Integer, default=0, nullable=False)
+    total_sq = Column(Integer, default=0, nullable=False)
+    h1 = Column(Integer, default=0, nullable=False)
+    h2 = Column(Integer, default=0, nullable=False)
+    h3 = Column(Integer, default=0, nullable=False)
+    h4 = Column(Integer, default=0, nullable=False)
+    h5 = Column(Integer, default=0, nullable=False)
+    h6 = Column(Integer, default=0, nullable=False)
+    h7 = Column(Integer, default=0, nullable=False)
+    h8 = Column(Integer, default=0, nullable=False)
+    h9 = Column(Integer, default=0, nullable=False)
+    h10 = Column(Integer, default=0, nullable=False)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    @property
+    def stddev(self) -> float:
+        if not self.count:
+            return 0.0
+        variance = self.total_sq / self.count - self.mean ** 2
+        return max(variance, 0.0) ** 0.5
+
+    @property
+    def histogram(self) -> list:
+        return [getattr(self, f'h{score}') for score in SCORE_VALUES]
+
+
+class ArtworkScore(ScoreAggregateMixin, Base):
+    """Агрегаты оценок картинки в рамках источника."""
+    __tablename__ = 'artwork_scores'
+    source_id = Column(Integer, ForeignKey('sources.source_id'), primary_key=True)
+    artwork_id = Column(Integer, ForeignKey('artworks.id'), primary_key=True)
+
+    artwork = relationship("Artwork")
+
+
+class SourceScore(ScoreAggregateMixin, Base):
+    """Агрегаты всех оценок источника."""
+    __tablename__ = 'source_scores'
+    source_id = Column(Integer, ForeignKey('sources.source_id'), primary_key=True)
+
+    source = relationship("Source")
@@ -0,0 +1,103 @@
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.utils.metrics import register_metrics
+
+logger = logging.getLogger(__name__)
+
+ProgressKey = Tuple[int, int]
+# (last_post_index, last_image_index); None - в БД прогресса точно нет
+ProgressValue = Optional[Tuple[int, int]]
+
+# Ключ в session.info: какие записи кэша изменены в еще не зафиксированной транзакции
+_TOUCHED_KEY = 'progress_cache_touched'
+MISSING = object()
+
+
+class ProgressCache:
+    """
+    Ограниченный write-through кэш прогресса по ключу (user_id, source_id).
+
+    Запись в кэш происходит вместе с записью в БД. Если транзакция, в которой
+    прогресс изменили, не будет зафиксирована, затронутые записи сбрасываются
+    (см. обработчики событий сессии ниже), и следующее чтение снова пойдет в БД.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[ProgressKey, ProgressValue]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_id: int, source_id: int) -> Any:
+        """Значение из кэша или MISSING, если записи нет."""
+        key = (user_id, source_id)
+        value = self._entries.get(key, MISSING)
+        if value is MISSING:
+            self.misses += 1
+            return MISSING
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, user_id: int, source_id: int, value: ProgressValue, session: Optional[Session] = None):
+        """
+        Кладет значение в кэш. С session запись считается незафиксированной,
+        пока транзакция этой сессии не завершится commit-ом.
+        """
+        key = (user_id, source_id)
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        if session is not None:
+            session.info.setdefault(_TOUCHED_KEY, set()).add(key)
+
+    def fill(self, user_id: int, source_id: int, value: ProgressValue):
+        """
+        Кладет значение, прочитанное из БД, только если запись еще не появилась:
+        пока шел SELECT, другой обработчик мог уже записать более новый прогресс.
+        """
+        if (user_id, source_id) not in self._entries:
+            self.put(user_id, source_id, value)
+
+    def invalidate(self, keys: Iterable[ProgressKey]):
+        for key in keys:
+            if self._entries.pop(key, MISSING) is not MISSING:
+                self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+progress_cache = ProgressCache(settings.progress_cache_size)
+register_metrics('progress_cache', progress_cache.stats)
+
+
+@event.listens_for(Session, 'after_commit')
+def _progress_committed(session: Session):
+    session.info.pop(_TOUCHED_KEY, None)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _progress_transaction_end(session: Session, transaction):
+    # Транзакция закончилась без commit (rollback или закрытие сессии) - кэш мог уйти вперед БД
+    if transaction.parent is None and _TOUCHED_KEY in session.info:
+        progress_cache.invalidate(session.info.pop(_TOUCHED_KEY))
@@ -0,0 +1,149 @@
+import bisect
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Set
+
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.utils.metrics import register_metrics
+from .models import Rating
+
+# Ключ в session.info: пользователи, в чьи множества добавлены еще не зафиксированные оценки
+_TOUCHED_KEY = 'rated_index_touched'
+
+
+class RatedSet:
+    """Отсортированный массив Artwork.id (4 байта на оценку); проверка - двоичным поиском."""
+    __slots__ = ('ids',)
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self.ids = array('I', ids)
+
+    def __contains__(self, artwork_id: int) -> bool:
+        i = bisect.bisect_left(self.ids, artwork_id)
+        return i < len(self.ids) and self.ids[i] == artwork_id
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, artwork_id: int) -> bool:
+        i = bisect.bisect_left(self.ids, artwork_id)
+        if i < len(self.ids) and self.ids[i] == artwork_id:
+            return False
+        self.ids.insert(i, artwork_id)
+        return True
+
+
+class RatedIndex:
+    """
+    Множества оцененных картинок по пользователям. Множество загружается из ratings
+    при первом обращении одним запросом по индексу (user_id, artwork_id), дальше
+    пополняется при добавлении оценок. Общее число id ограничено, пользователи
+    вытесняются по LRU.
+
+    Индекс используют перебор окон непроиндексированного файла (get_next_unrated_artwork)
+    и альбомы (get_rated_artwork_ids). Проиндексированные файлы и снимки запросов
+    пропускают оцененное в самом SQL-запросе (NOT EXISTS) и индекс не читают.
+    """
+
+    def __init__(self, max_ids: int):
+        self.max_ids = max_ids
+        self._sets: "OrderedDict[int, RatedSet]" = OrderedDict()
+        self._total = 0
+        # Оценки, добавленные, пока множество пользователя загружается из БД
+        self._loading: Dict[int, Set[int]] = {}
+
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    async def get(self, session: AsyncSession, user_id: int) -> RatedSet:
+        rated = self._sets.get(user_id)
+        if rated is not None:
+            self.hits += 1
+            self._sets.move_to_end(user_id)
+            return rated
+
+        self.loads += 1
+        added = self._loading.setdefault(user_id, set())
+        try:
+            stmt = select(Rating.artwork_id).where(Rating.user_id == user_id).order_by(Rating.artwork_id)
+            rated = RatedSet((await session.execute(stmt)).scalars())
+        finally:
+            current = self._loading.pop(user_id, None) if self._loading.get(user_id) is added else None
+        if current is None:
+            # Пользователя сбросили (откат) или загрузила параллельная задача - в индекс не кладем
+            return self._sets.get(user_id, rated)
+        # Оценки, записанные во время SELECT, могли в него не попасть
+        for artwork_id in added:
+            rated.add(artwork_id)
+
+        if user_id in self._sets:
+            # Параллельная загрузка успела раньше - ее множество уже пополняется
+            return self._sets[user_id]
+        self._sets[user_id] = rated
+        self._total += len(rated)
+        self._evict()
+        return rated
+
+    def add(self, user_id: int, artwork_ids: Iterable[int], session: Optional[Session] = None):
+        """
+        Отмечает картинки оцененными. С session пользователь сбрасывается из индекса,
+        если транзакция завершится без commit.
+        """
+        rated = self._sets.get(user_id)
+        if rated is not None:
+            for artwork_id in artwork_ids:
+                self._total += rated.add(artwork_id)
+            self._evict()
+        elif user_id in self._loading:
+            self._loading[user_id].update(artwork_ids)
+        if session is not None:
+            session.info.setdefault(_TOUCHED_KEY, set()).add(user_id)
+
+    def invalidate(self, user_ids: Iterable[int]):
+        for user_id in user_ids:
+            rated = self._sets.pop(user_id, None)
+            if rated is not None:
+                self._total -= len(rated)
+                self.invalidations += 1
+            # Загрузка, начатая до отката, тоже не должна попасть в индекс
+            self._loading.pop(user_id, None)
+
+    def _evict(self):
+        # Последнего (только что использованного) пользователя не вытесняем, даже если он один больше лимита
+        while self._total > self.max_ids and len(self._sets) > 1:
+            _, rated = self._sets.popitem(last=False)
+            self._total -= len(rated)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'users': len(self._sets),
+            'ids': self._total,
+            'bytes': self._total * array('I').itemsize,
+            'hits': self.hits,
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+rated_index = RatedIndex(settings.rated_index_max_ids)
+register_metrics('rated_index', rated_index.stats)
+
+
+@event.listens_for(Session, 'after_commit')
+def _rated_committed(session: Session):
+    session.info.pop(_TOUCHED_KEY, None)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _rated_transaction_end(session: Session, transaction):
+    # Транзакция закончилась без commit - в индексе могли остаться не сохраненные оценки
+    if transaction.parent is None and _TOUCHED_KEY in session.info:
+        rated_index.invalidate(session.info.pop(_TOUCHED_KEY))
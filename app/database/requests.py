@@ -1,23 +1,39 @@
 import json
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, delete
-from sqlalchemy.orm import selectinload
+from sqlalchemy import select, delete, update, and_, or_, exists, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
-from .models import User, Artwork, Source, Rating, UserProgress
+from .models import User, Artwork, Source, Rating, UserProgress, SourceImage, ExportWatermark, ArtworkScore, SourceScore
+from .scores import bump_score_aggregates, UPSERT_CHUNK_SIZE
+from .progress_cache import progress_cache, MISSING as PROGRESS_MISSING
+from .user_cache import user_cache, UserSnapshot
+from .file_id_cache import file_id_cache, MISSING as FILE_ID_MISSING
+from .rated_index import rated_index
+from .write_behind import write_behind
+
+# Функции этого модуля не фиксируют транзакцию сами: изменения только отправляются в БД (flush),
+# а commit/rollback делает владелец сессии - DbSessionMiddleware или фоновая задача.
 
 # --- User Functions ---
 
-async def get_or_create_user(session: AsyncSession, user_id: int, username: str = None):
-    """Получает пользователя из БД или создает нового, если его нет."""
+async def get_user_snapshot(session: AsyncSession, user_id: int, username: str = None) -> UserSnapshot:
+    """Снимок пользователя из кэша; при промахе - из БД (с созданием нового пользователя)."""
+    snapshot = user_cache.get(user_id)
+    if snapshot is not None:
+        return snapshot
+
     stmt = select(User).where(User.user_id == user_id)
     result = await session.execute(stmt)
     user = result.scalar_one_or_none()
     if not user:
-        user = User(user_id=user_id, username=username)
-        session.add(user)
-        await session.commit()
-        await session.refresh(user)
-    return user
+        session.add(User(user_id=user_id, username=username))
+        await session.flush()
+        # Новый пользователь появится в БД только после commit, поэтому его пока не кэшируем
+        return UserSnapshot(user_id, username, False)
+
+    snapshot = UserSnapshot(user.user_id, user.username, bool(user.is_authorized))
+    user_cache.put(snapshot)
+    return snapshot
 
 async def authorize_user(session: AsyncSession, user_id: int):
     """Авторизует пользователя."""
@@ -26,7 +42,8 @@ async def authorize_user(session: AsyncSession, user_id: int):
     user = result.scalar_one_or_none()
     if user:
         user.is_authorized = True
-        await session.commit()
+        await session.flush()
+        user_cache.invalidate(user_id, session=session.sync_session)
     return user
 
 # --- Source and Artwork Functions ---
@@ -41,7 +58,7 @@ async def add_file_source(session: AsyncSession, filename: str, filepath: str, o
         owner_id=owner_id
     )
     session.add(new_source)
-    await session.commit()
+    await session.flush()
     return new_source
 
 async def get_all_file_sources(session: AsyncSession):
@@ -92,36 +109,194 @@ async def delete_source_by_owner(session: AsyncSession, source_id: int, owner_id
     if source_to_deactivate:
         # Вместо удаления, просто меняем флаг и сохраняем
         source_to_deactivate.is_active = False
-        await session.commit()
+        await session.flush()
         return True
 
     return False
 
 
-async def get_or_create_artwork(session: AsyncSession, formatted_art: dict, image_index: int):
-    """Находит или создает запись для КОНКРЕТНОЙ КАРТИНКИ из поста."""
-    pixiv_id = formatted_art['id']
-    stmt = select(Artwork).where(Artwork.pixiv_id == pixiv_id, Artwork.image_index == image_index)
+# --- File Ingestion Functions ---
+
+def is_source_ingested(source: Source) -> bool:
+    """Проверяет, проиндексирован ли файл-источник в таблицу source_images."""
+    return (source.details or {}).get('ingest', {}).get('status') == 'done'
+
+async def set_source_ingest_status(session: AsyncSession, source_id: int, status: str, posts: int = None):
+    """Сохраняет состояние индексации файла в details источника."""
+    source = await get_source_by_id(session, source_id)
+    if not source:
+        return None
+    ingest = {'status': status}
+    if posts is not None:
+        ingest['posts'] = posts
+    # JSON-поле отслеживается только при присваивании нового объекта
+    source.details = {**source.details, 'ingest': ingest}
+    await session.flush()
+    return source
+
+async def get_sources_pending_ingestion(session: AsyncSession):
+    """Получает активные файлы, индексация которых не была начата или была прервана."""
+    files = await get_all_file_sources(session)
+    return [
+        source for source in files
+        if (source.details or {}).get('ingest', {}).get('status') not in ('done', 'failed')
+    ]
+
+async def clear_source_images(session: AsyncSession, source_id: int):
+    """Удаляет результаты предыдущей (возможно, прерванной) индексации."""
+    await session.execute(delete(SourceImage).where(SourceImage.source_id == source_id))
+
+async def add_source_images(session: AsyncSession, source_id: int, posts: list):
+    """
+    Индексирует пачку постов файла или снимка запроса.
+    posts - список пар (post_index, formatted_art). Уже записанные позиции не перезаписываются.
+    """
+    artwork_ids = await upsert_artworks(session, posts)
+    rows = [
+        {
+            'source_id': source_id,
+            'post_index': post_index,
+            'image_index': img_idx,
+            'artwork_id': artwork_ids[(formatted_art['id'], img_idx)],
+        }
+        for post_index, formatted_art in posts
+        for img_idx in range(len(formatted_art.get('all_image_urls', [])))
+    ]
+    for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+        stmt = sqlite_insert(SourceImage).values(rows[start:start + UPSERT_CHUNK_SIZE])
+        stmt = stmt.on_conflict_do_nothing(index_elements=['source_id', 'post_index', 'image_index'])
+        await session.execute(stmt)
+
+# --- Query Snapshot Functions ---
+
+def get_query_snapshot_cursor(source: Source) -> dict:
+    """
+    Курсор снимка запроса: offset следующей страницы Pixiv, число постов в снимке
+    и признак того, что выдача закончилась.
+    """
+    return (source.details or {}).get('snapshot', {'offset': 0, 'posts': 0, 'exhausted': False})
+
+async def set_query_snapshot_cursor(session: AsyncSession, source_id: int, offset: int, posts: int,
+                                    exhausted: bool):
+    source = await get_source_by_id(session, source_id)
+    if not source:
+        return None
+    # JSON-поле отслеживается только при присваивании нового объекта
+    source.details = {**source.details, 'snapshot': {'offset': offset, 'posts': posts, 'exhausted': exhausted}}
+    await session.flush()
+    return source
+
+async def get_snapshot_pixiv_ids(session: AsyncSession, source_id: int, pixiv_ids) -> set:
+    """Какие из pixiv_ids уже есть в снимке источника - одним запросом."""
+    if not pixiv_ids:
+        return set()
+    stmt = (
+        select(Artwork.pixiv_id)
+        .join(SourceImage, SourceImage.artwork_id == Artwork.id)
+        .where(SourceImage.source_id == source_id, SourceImage.image_index == 0,
+               Artwork.pixiv_id.in_(pixiv_ids))
+    )
     result = await session.execute(stmt)
-    artwork = result.scalar_one_or_none()
+    return set(result.scalars())
 
-    if not artwork:
-        artwork = Artwork(
-            pixiv_id=pixiv_id,
-            image_index=image_index,
-            title=formatted_art.get('title'),
-            author=formatted_art.get('author'),
-            url=formatted_art.get('url'),
-            # В other_data кладем все, включая URL всех картинок серии
-            other_data=formatted_art
+async def get_next_unrated_source_image(session: AsyncSession, user_id: int, source_id: int,
+                                        post_index: int, image_index: int, skip_artwork_ids=()):
+    """
+    Находит первую картинку файла или снимка запроса, начиная с позиции (post_index, image_index),
+    которую пользователь еще не оценил. skip_artwork_ids - картинки, оценки которых еще не записаны.
+    Возвращает пару (SourceImage, Artwork) или None.
+    """
+    stmt = (
+        select(SourceImage, Artwork)
+        .join(Artwork, SourceImage.artwork_id == Artwork.id)
+        .where(
+            SourceImage.source_id == source_id,
+            or_(
+                SourceImage.post_index > post_index,
+                and_(SourceImage.post_index == post_index, SourceImage.image_index >= image_index)
+            ),
+            ~exists().where(Rating.user_id == user_id, Rating.artwork_id == SourceImage.artwork_id)
         )
-        session.add(artwork)
-        await session.commit()
-        await session.refresh(artwork)
-    return artwork
+        .order_by(SourceImage.post_index, SourceImage.image_index)
+        .limit(1)
+    )
+    # Оценки, которые еще лежат в буфере отложенной записи
+    pending_ids = write_behind.pending_rated_ids(user_id) | set(skip_artwork_ids)
+    if pending_ids:
+        stmt = stmt.where(SourceImage.artwork_id.not_in(pending_ids))
+    result = await session.execute(stmt)
+    return result.first()
+
+async def upsert_artworks(session: AsyncSession, posts: list) -> dict:
+    """
+    Создает недостающие Artwork для всех картинок постов пачкой INSERT ... ON CONFLICT DO NOTHING.
+    posts - список пар (post_index, formatted_art).
+    Возвращает словарь (pixiv_id, image_index) -> Artwork.id.
+    """
+    rows = [
+        {
+            'pixiv_id': formatted_art['id'],
+            'image_index': img_idx,
+            'title': formatted_art.get('title'),
+            'author': formatted_art.get('author'),
+            'url': formatted_art.get('url'),
+            'other_data': formatted_art,
+        }
+        for _, formatted_art in posts
+        for img_idx in range(len(formatted_art.get('all_image_urls', [])))
+    ]
+    for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+        stmt = sqlite_insert(Artwork).values(rows[start:start + UPSERT_CHUNK_SIZE])
+        stmt = stmt.on_conflict_do_nothing(index_elements=['pixiv_id', 'image_index'])
+        await session.execute(stmt)
+
+    pixiv_ids = {formatted_art['id'] for _, formatted_art in posts}
+    stmt = select(Artwork.id, Artwork.pixiv_id, Artwork.image_index).where(Artwork.pixiv_id.in_(pixiv_ids))
+    result = await session.execute(stmt)
+    return {(pixiv_id, image_index): artwork_id for artwork_id, pixiv_id, image_index in result}
+
+async def get_next_unrated_artwork(session: AsyncSession, user_id: int, posts: list,
+                                   start_post_index: int, start_image_index: int, skip_artwork_ids=()):
+    """
+    Находит первую неоцененную пользователем картинку среди постов страницы/окна файла
+    за постоянное число запросов: пачка upsert-ов Artwork, оценки проверяются по rated_index.
+    posts - список пар (post_index, formatted_art) в порядке просмотра.
+    skip_artwork_ids - картинки, оценки которых еще не записаны.
+    Возвращает (post_index, image_index, formatted_art, artwork_id) или None.
+    """
+    if not posts:
+        return None
+    artworks = await upsert_artworks(session, posts)
+    rated = await rated_index.get(session, user_id)
+
+    for post_index, formatted_art in posts:
+        for img_idx in range(len(formatted_art.get('all_image_urls', []))):
+            # Пропускаем уже просмотренные картинки в первом посте
+            if post_index == start_post_index and img_idx < start_image_index:
+                continue
+            artwork_id = artworks[(formatted_art['id'], img_idx)]
+            if (artwork_id not in rated and artwork_id not in skip_artwork_ids
+                    and not write_behind.is_rated(user_id, artwork_id)):
+                return post_index, img_idx, formatted_art, artwork_id
+    return None
 
 # --- Rating and Progress Functions ---
 
+async def get_telegram_file_id(session: AsyncSession, artwork_id: int):
+    """file_id уже загруженного в Telegram фото картинки или None."""
+    file_id = file_id_cache.get(artwork_id)
+    if file_id is FILE_ID_MISSING:
+        stmt = select(Artwork.telegram_file_id).where(Artwork.id == artwork_id)
+        result = await session.execute(stmt)
+        file_id = result.scalar_one_or_none()
+        file_id_cache.put(artwork_id, file_id)
+    return file_id
+
+async def set_telegram_file_id(session: AsyncSession, artwork_id: int, file_id):
+    """Запоминает file_id фото (None - забыть устаревший)."""
+    file_id_cache.put(artwork_id, file_id)
+    await session.execute(update(Artwork).where(Artwork.id == artwork_id).values(telegram_file_id=file_id))
+
 async def add_rating(session: AsyncSession, user_id: int, artwork_id: int, source_id: int, score: int):
     """Добавляет новую оценку."""
     new_rating = Rating(
@@ -130,49 +305,115 @@ async def add_rating(session: AsyncSession, user_id: int, artwork_id: int, sourc
         source_id=source_id,
         score=score
     )
+    if write_behind.enabled:
+        # Оценка будет записана фоновой задачей вместе с другими
+        write_behind.add_rating(user_id, artwork_id, source_id, score)
+        rated_index.add(user_id, [artwork_id])
+        return new_rating
     session.add(new_rating)
-    await session.commit()
+    await session.flush()
+    rated_index.add(user_id, [artwork_id], session=session.sync_session)
+    # Агрегаты обновляются в той же транзакции, что и сама оценка
+    await bump_score_aggregates(session, [(source_id, artwork_id, score)])
     return new_rating
 
-async def check_user_rating_for_artwork(session: AsyncSession, user_id: int, artwork_id: int):
-    """Проверяет оценку по НОВОМУ уникальному ID картинки."""
-    stmt = select(Rating).where(Rating.user_id == user_id, Rating.artwork_id == artwork_id)
-    result = await session.execute(stmt)
-    return result.scalar_one_or_none() is not None
+async def add_ratings(session: AsyncSession, user_id: int, source_id: int, scores: dict):
+    """
+    Добавляет оценки нескольких картинок одним запросом (альбом из поста).
+    scores - {artwork_id: score}. Уже оцененные картинки пропускаются.
+    """
+    if not scores:
+        return 0
+    if write_behind.enabled:
+        for artwork_id, score in scores.items():
+            write_behind.add_rating(user_id, artwork_id, source_id, score)
+        rated_index.add(user_id, scores)
+        return len(scores)
+    stmt = sqlite_insert(Rating).values([
+        {'user_id': user_id, 'artwork_id': artwork_id, 'source_id': source_id, 'score': score}
+        for artwork_id, score in scores.items()
+    ])
+    stmt = stmt.on_conflict_do_nothing(index_elements=['user_id', 'artwork_id'])
+    stmt = stmt.returning(Rating.source_id, Rating.artwork_id, Rating.score)
+    inserted = (await session.execute(stmt)).all()
+    await bump_score_aggregates(session, inserted)
+    rated_index.add(user_id, scores, session=session.sync_session)
+    return len(inserted)
+
+async def get_rated_artwork_ids(session: AsyncSession, user_id: int, artwork_ids: list) -> set:
+    """Какие из artwork_ids пользователь уже оценил - по rated_index и буферу отложенной записи."""
+    rated = await rated_index.get(session, user_id)
+    return {artwork_id for artwork_id in artwork_ids
+            if artwork_id in rated or write_behind.is_rated(user_id, artwork_id)}
+
+def _progress_row(user_id: int, source_id: int, value):
+    """Несохраненный объект прогресса для значений из памяти (кэш или буфер отложенной записи)."""
+    if value is None:
+        return None
+    return UserProgress(user_id=user_id, source_id=source_id,
+                        last_post_index=value[0], last_image_index=value[1])
 
 async def get_user_progress(session: AsyncSession, user_id: int, source_id: int):
     """Получает прогресс пользователя по источнику."""
-    stmt = select(UserProgress).where(UserProgress.user_id == user_id, UserProgress.source_id == source_id)
+    pending = write_behind.get_progress(user_id, source_id)
+    if pending is not None:
+        # Несброшенный прогресс новее, чем строка в БД
+        return _progress_row(user_id, source_id, pending)
+    cached = progress_cache.get(user_id, source_id)
+    if cached is not PROGRESS_MISSING:
+        return _progress_row(user_id, source_id, cached)
+    stmt = select(UserProgress.last_post_index, UserProgress.last_image_index).where(
+        UserProgress.user_id == user_id, UserProgress.source_id == source_id
+    )
     result = await session.execute(stmt)
-    return result.scalar_one_or_none()
+    row = result.one_or_none()
+    value = tuple(row) if row else None
+    progress_cache.fill(user_id, source_id, value)
+    return _progress_row(user_id, source_id, value)
+
+async def get_user_progress_for_sources(session: AsyncSession, user_id: int, source_ids: list) -> dict:
+    """Прогресс пользователя сразу по нескольким источникам: {source_id: UserProgress}, одним запросом на промахи кэша."""
+    values = {}
+    missing = []
+    for source_id in source_ids:
+        pending = write_behind.get_progress(user_id, source_id)
+        cached = pending if pending is not None else progress_cache.get(user_id, source_id)
+        if cached is PROGRESS_MISSING:
+            missing.append(source_id)
+        else:
+            values[source_id] = cached
+
+    if missing:
+        stmt = select(UserProgress.source_id, UserProgress.last_post_index, UserProgress.last_image_index).where(
+            UserProgress.user_id == user_id, UserProgress.source_id.in_(missing)
+        )
+        result = await session.execute(stmt)
+        found = {source_id: (post_index, image_index) for source_id, post_index, image_index in result}
+        for source_id in missing:
+            values[source_id] = found.get(source_id)
+            progress_cache.fill(user_id, source_id, values[source_id])
+
+    return {source_id: _progress_row(user_id, source_id, value)
+            for source_id, value in values.items() if value is not None}
 
 async def update_user_progress(session: AsyncSession, user_id: int, source_id: int, post_index: int, image_index: int):
     """Обновляет или создает прогресс пользователя с двумя индексами."""
-    progress = await get_user_progress(session, user_id, source_id)
-    if progress:
-        progress.last_post_index = post_index
-        progress.last_image_index = image_index
-    else:
-        progress = UserProgress(
-            user_id=user_id,
-            source_id=source_id,
-            last_post_index=post_index,
-            last_image_index=image_index
-        )
-        session.add(progress)
-    await session.commit()
-    return progress
-
-async def get_user_ratings_for_export(session: AsyncSession, user_id: int):
-    """Получает все оценки пользователя для экспорта."""
-    stmt = select(Rating).where(Rating.user_id == user_id).options(
-        # Добавляем selectinload(Rating.user), чтобы сразу подгрузить данные пользователя
-        selectinload(Rating.user),
-        selectinload(Rating.artwork),
-        selectinload(Rating.source)
+    if write_behind.enabled:
+        write_behind.update_progress(user_id, source_id, post_index, image_index)
+        progress_cache.put(user_id, source_id, (post_index, image_index))
+        return _progress_row(user_id, source_id, (post_index, image_index))
+    # Один UPSERT вместо чтения и последующей записи
+    stmt = sqlite_insert(UserProgress).values(
+        user_id=user_id, source_id=source_id, last_post_index=post_index, last_image_index=image_index
     )
-    result = await session.execute(stmt)
-    return result.scalars().all()
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'source_id'],
+        set_={'last_post_index': stmt.excluded.last_post_index, 'last_image_index': stmt.excluded.last_image_index}
+    )
+    await session.execute(stmt)
+    # Запись в кэш привязана к транзакции сессии: при откате она будет сброшена
+    progress_cache.put(user_id, source_id, (post_index, image_index), session=session.sync_session)
+    return _progress_row(user_id, source_id, (post_index, image_index))
 
 async def add_query_source(session: AsyncSession, name: str, query_details: dict, owner_id: int):
     """Добавляет новый источник типа 'query'."""
@@ -183,17 +424,101 @@ async def add_query_source(session: AsyncSession, name: str, query_details: dict
         owner_id=owner_id
     )
     session.add(new_source)
-    await session.commit()
-    await session.refresh(new_source)
+    await session.flush()
     return new_source
 
-async def get_all_ratings_for_export(session: AsyncSession):
-    """Получает все оценки всех пользователей для экспорта."""
-    stmt = select(Rating).options(
-        # Здесь эта строка уже была, но для консистентности оставляем
-        selectinload(Rating.user),
-        selectinload(Rating.artwork),
-        selectinload(Rating.source)
-    ).order_by(Rating.user_id, Rating.created_at)
+def _ratings_export_query(user_id: int = None, since_rating_id: int = None, until_rating_id: int = None):
+    """
+    Плоская проекция оценок для экспорта: одна строка на оценку без ORM-объектов.
+    С since_rating_id выбираются только оценки новее отметки - диапазоном по rating_id.
+    """
+    stmt = (
+        select(
+            Rating.user_id, User.username, Artwork.pixiv_id, Artwork.title, Artwork.author,
+            Artwork.url, Rating.score, Source.name, Rating.created_at
+        )
+        .join(User, Rating.user_id == User.user_id)
+        .join(Artwork, Rating.artwork_id == Artwork.id)
+        .outerjoin(Source, Rating.source_id == Source.source_id)
+    )
+    if user_id is not None:
+        stmt = stmt.where(Rating.user_id == user_id)
+    if until_rating_id is not None:
+        stmt = stmt.where(Rating.rating_id <= until_rating_id)
+    if since_rating_id is not None:
+        return stmt.where(Rating.rating_id > since_rating_id).order_by(Rating.rating_id)
+    return stmt.order_by(Rating.user_id, Rating.created_at)
+
+async def stream_ratings_for_export(session: AsyncSession, user_id: int = None, since_rating_id: int = None,
+                                    until_rating_id: int = None, chunk_size: int = 5000):
+    """
+    Отдает оценки для экспорта пачками по chunk_size строк, не загружая всю таблицу в память.
+    Если user_id не указан - оценки всех пользователей.
+    """
+    stmt = _ratings_export_query(user_id, since_rating_id, until_rating_id).execution_options(yield_per=chunk_size)
+    result = await session.stream(stmt)
+    async for partition in result.partitions():
+        yield partition
+
+async def get_max_rating_id(session: AsyncSession, user_id: int = None):
+    """Последний rating_id (всех оценок или одного пользователя), None если оценок нет."""
+    stmt = select(func.max(Rating.rating_id))
+    if user_id is not None:
+        stmt = stmt.where(Rating.user_id == user_id)
+    result = await session.execute(stmt)
+    return result.scalar_one_or_none()
+
+async def get_export_watermark(session: AsyncSession, requester_id: int, target: str):
+    """Получает rating_id, до которого запросивший уже выгружал эту цель."""
+    stmt = select(ExportWatermark.last_rating_id).where(
+        ExportWatermark.requester_id == requester_id, ExportWatermark.target == target
+    )
+    result = await session.execute(stmt)
+    return result.scalar_one_or_none()
+
+async def set_export_watermark(session: AsyncSession, requester_id: int, target: str, last_rating_id: int):
+    """Сдвигает отметку экспорта вперед."""
+    stmt = select(ExportWatermark).where(
+        ExportWatermark.requester_id == requester_id, ExportWatermark.target == target
+    )
+    result = await session.execute(stmt)
+    watermark = result.scalar_one_or_none()
+    if watermark:
+        watermark.last_rating_id = last_rating_id
+    else:
+        watermark = ExportWatermark(requester_id=requester_id, target=target, last_rating_id=last_rating_id)
+        session.add(watermark)
+    await session.flush()
+    return watermark
+
+async def get_source_scores(session: AsyncSession, limit: int = 20):
+    """Источники с агрегатами оценок, самые оцениваемые - первыми."""
+    stmt = (
+        select(SourceScore, Source)
+        .join(Source, SourceScore.source_id == Source.source_id)
+        .where(Source.is_active == True)
+        .order_by(SourceScore.count.desc())
+        .limit(limit)
+    )
+    result = await session.execute(stmt)
+    return result.all()
+
+async def get_source_score(session: AsyncSession, source_id: int):
+    stmt = select(SourceScore).where(SourceScore.source_id == source_id)
+    result = await session.execute(stmt)
+    return result.scalar_one_or_none()
+
+async def get_source_leaderboard(session: AsyncSession, source_id: int, limit: int = 10, min_count: int = 1):
+    """
+    Топ картинок источника по средней оценке. Читает только агрегаты (по строке на картинку),
+    а не сами оценки. При равном среднем выше та, у которой больше оценок.
+    """
+    stmt = (
+        select(ArtworkScore, Artwork)
+        .join(Artwork, ArtworkScore.artwork_id == Artwork.id)
+        .where(ArtworkScore.source_id == source_id, ArtworkScore.count >= min_count)
+        .order_by((ArtworkScore.total * 1.0 / ArtworkScore.count).desc(), ArtworkScore.count.desc())
+        .limit(limit)
+    )
     result = await session.execute(stmt)
-    return result.scalars().all()
\ No newline at end of file
+    return result.all()
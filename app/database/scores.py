@@ -0,0 +1,84 @@
+from typing import Iterable, Tuple, Union
+
+from sqlalchemy import case, delete, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
+from .models import ArtworkScore, Rating, SourceScore, SCORE_VALUES
+
+# Сколько строк вставлять одним INSERT: число параметров в запросе SQLite ограничено
+# (по умолчанию 32766, в старых сборках 999), а строка агрегата - это 15 параметров
+UPSERT_CHUNK_SIZE = 500
+
+# Числовые столбцы агрегатов, которые при конфликте складываются
+AGGREGATE_COLUMNS = ['count', 'total', 'total_sq'] + [f'h{score}' for score in SCORE_VALUES]
+
+
+def _increment(score: int) -> dict:
+    values = {'count': 1, 'total': score, 'total_sq': score * score}
+    for value in SCORE_VALUES:
+        values[f'h{value}'] = int(score == value)
+    return values
+
+
+async def _upsert_increments(session: AsyncSession, model, key_columns: list, rows: list):
+    for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+        stmt = sqlite_insert(model).values(rows[start:start + UPSERT_CHUNK_SIZE])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=key_columns,
+            set_={column: getattr(model, column) + getattr(stmt.excluded, column) for column in AGGREGATE_COLUMNS}
+        )
+        await session.execute(stmt)
+
+
+async def bump_score_aggregates(session: AsyncSession, ratings: Iterable[Tuple[int, int, int]]):
+    """
+    Добавляет новые оценки (source_id, artwork_id, score) в агрегаты картинок и источников.
+    Вызывается в той же транзакции, что и вставка оценок, поэтому агрегаты не расходятся с ratings.
+    """
+    artwork_rows, source_rows = [], {}
+    for source_id, artwork_id, score in ratings:
+        increment = _increment(score)
+        artwork_rows.append({'source_id': source_id, 'artwork_id': artwork_id, **increment})
+        # По источнику сначала суммируем в памяти - одна строка UPSERT на источник
+        summed = source_rows.setdefault(source_id, dict.fromkeys(AGGREGATE_COLUMNS, 0))
+        for column, value in increment.items():
+            summed[column] += value
+    if not artwork_rows:
+        return
+
+    await _upsert_increments(session, ArtworkScore, ['source_id', 'artwork_id'], artwork_rows)
+    await _upsert_increments(session, SourceScore, ['source_id'], [
+        {'source_id': source_id, **values} for source_id, values in source_rows.items()
+    ])
+
+
+def _aggregate_select(*group_columns):
+    return select(
+        *group_columns,
+        func.count(),
+        func.sum(Rating.score),
+        func.sum(Rating.score * Rating.score),
+        *[func.sum(case((Rating.score == value, 1), else_=0)) for value in SCORE_VALUES]
+    ).group_by(*group_columns)
+
+
+async def rebuild_score_aggregates(session: Union[AsyncSession, AsyncConnection]):
+    """
+    Пересчитывает агрегаты с нуля по таблице ratings.
+    Принимает и сессию (ручное восстановление), и соединение (шаг миграции).
+    """
+    await session.execute(delete(ArtworkScore))
+    await session.execute(delete(SourceScore))
+    await session.execute(
+        sqlite_insert(ArtworkScore).from_select(
+            ['source_id', 'artwork_id'] + AGGREGATE_COLUMNS,
+            _aggregate_select(Rating.source_id, Rating.artwork_id)
+        )
+    )
+    await session.execute(
+        sqlite_insert(SourceScore).from_select(
+            ['source_id'] + AGGREGATE_COLUMNS,
+            _aggregate_select(Rating.source_id)
+        )
+    )
@@ -0,0 +1,82 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.utils.metrics import register_metrics
+
+# Ключ в session.info: пользователи, запись о которых изменена в текущей транзакции
+_CHANGED_KEY = 'user_cache_changed'
+
+
+class UserSnapshot(NamedTuple):
+    """Неизменяемый снимок пользователя, который отдается хендлерам вместо ORM-объекта."""
+    user_id: int
+    username: Optional[str]
+    is_authorized: bool
+
+
+class UserCache:
+    """
+    Кэш пользователей с TTL. Снимок читается из БД не чаще раза в ttl секунд,
+    а изменения (авторизация) сбрасывают запись явно через invalidate.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # user_id -> (время загрузки, снимок)
+        self._entries: "OrderedDict[int, Tuple[float, UserSnapshot]]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id: int) -> Optional[UserSnapshot]:
+        entry = self._entries.get(user_id)
+        if entry is None or time.monotonic() - entry[0] >= self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(user_id)
+        return entry[1]
+
+    def put(self, snapshot: UserSnapshot):
+        self._entries[snapshot.user_id] = (time.monotonic(), snapshot)
+        self._entries.move_to_end(snapshot.user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int, session: Optional[Session] = None):
+        """
+        Сбрасывает запись. С session она сбрасывается еще раз по окончании транзакции:
+        иначе до commit другой обработчик успел бы закэшировать старое значение.
+        """
+        if self._entries.pop(user_id, None) is not None:
+            self.invalidations += 1
+        if session is not None:
+            session.info.setdefault(_CHANGED_KEY, set()).add(user_id)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'invalidations': self.invalidations,
+        }
+
+
+user_cache = UserCache(settings.user_cache_ttl, settings.user_cache_size)
+register_metrics('user_cache', user_cache.stats)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _user_transaction_end(session: Session, transaction):
+    if transaction.parent is None and _CHANGED_KEY in session.info:
+        for user_id in session.info.pop(_CHANGED_KEY):
+            user_cache.invalidate(user_id)
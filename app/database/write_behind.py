@@ -0,0 +1,188 @@
+import asyncio
+import itertools
+import logging
+from typing import Any, Dict, Optional, Set, Tuple
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.core.config import settings
+from app.utils.metrics import register_metrics
+from .engine import async_session_factory
+from .models import Rating, UserProgress
+from .scores import bump_score_aggregates, UPSERT_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """
+    Отложенная запись оценок и прогресса.
+
+    Хендлеры только кладут изменения в память, а единственная фоновая задача
+    сбрасывает их в БД пачками (многострочные INSERT/UPSERT) раз в flush_interval
+    или при накоплении max_batch записей. За один сброс пишется не больше max_batch
+    оценок и max_batch записей прогресса, поэтому накопившийся хвост уходит по частям.
+    Пока запись не сброшена, она же служит "наложением" для чтения, поэтому оценка
+    видит свои несохраненные изменения.
+    """
+
+    def __init__(self, session_pool: async_sessionmaker, enabled: bool, flush_interval: float, max_batch: int):
+        self.session_pool = session_pool
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+
+        # (user_id, artwork_id) -> строка для вставки в ratings
+        self._ratings: Dict[Tuple[int, int], Dict[str, Any]] = {}
+        # (user_id, source_id) -> (last_post_index, last_image_index); хранится только последнее значение
+        self._progress: Dict[Tuple[int, int], Tuple[int, int]] = {}
+
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+        self.flushes = 0
+        self.flushed_ratings = 0
+        self.flushed_progress = 0
+        self.failed_flushes = 0
+
+    # --- Запись ---
+
+    def add_rating(self, user_id: int, artwork_id: int, source_id: int, score: int):
+        # Повторная оценка той же картинки отбрасывается, как и уникальным ограничением в БД
+        self._ratings.setdefault((user_id, artwork_id), {
+            'user_id': user_id,
+            'artwork_id': artwork_id,
+            'source_id': source_id,
+            'score': score,
+        })
+        self._maybe_wakeup()
+
+    def update_progress(self, user_id: int, source_id: int, post_index: int, image_index: int):
+        self._progress[(user_id, source_id)] = (post_index, image_index)
+        self._maybe_wakeup()
+
+    def _maybe_wakeup(self):
+        if len(self._ratings) + len(self._progress) >= self.max_batch:
+            self._wakeup.set()
+
+    # --- Чтение несброшенных данных ---
+
+    def get_progress(self, user_id: int, source_id: int) -> Optional[Tuple[int, int]]:
+        return self._progress.get((user_id, source_id))
+
+    def is_rated(self, user_id: int, artwork_id: int) -> bool:
+        return (user_id, artwork_id) in self._ratings
+
+    def pending_rated_ids(self, user_id: int) -> Set[int]:
+        return {artwork_id for rated_user_id, artwork_id in self._ratings if rated_user_id == user_id}
+
+    # --- Сброс в БД ---
+
+    async def flush(self):
+        """Сбрасывает очередную пачку (до max_batch записей каждого вида) одной транзакцией."""
+        async with self._flush_lock:
+            if not self._ratings and not self._progress:
+                return
+            ratings = dict(itertools.islice(self._ratings.items(), self.max_batch))
+            progress = dict(itertools.islice(self._progress.items(), self.max_batch))
+
+            try:
+                async with self.session_pool() as session:
+                    rating_rows = list(ratings.values())
+                    # Запросы режутся на части, чтобы не превысить лимит параметров SQLite
+                    for start in range(0, len(rating_rows), UPSERT_CHUNK_SIZE):
+                        stmt = sqlite_insert(Rating).values(rating_rows[start:start + UPSERT_CHUNK_SIZE])
+                        stmt = stmt.on_conflict_do_nothing(index_elements=['user_id', 'artwork_id'])
+                        # RETURNING отдает только реально вставленные строки - дубли в агрегаты не попадут
+                        stmt = stmt.returning(Rating.source_id, Rating.artwork_id, Rating.score)
+                        inserted = (await session.execute(stmt)).all()
+                        await bump_score_aggregates(session, inserted)
+                    progress_rows = [
+                        {'user_id': user_id, 'source_id': source_id,
+                         'last_post_index': post_index, 'last_image_index': image_index}
+                        for (user_id, source_id), (post_index, image_index) in progress.items()
+                    ]
+                    for start in range(0, len(progress_rows), UPSERT_CHUNK_SIZE):
+                        stmt = sqlite_insert(UserProgress).values(progress_rows[start:start + UPSERT_CHUNK_SIZE])
+                        stmt = stmt.on_conflict_do_update(
+                            index_elements=['user_id', 'source_id'],
+                            set_={
+                                'last_post_index': stmt.excluded.last_post_index,
+                                'last_image_index': stmt.excluded.last_image_index,
+                            }
+                        )
+                        await session.execute(stmt)
+                    await session.commit()
+            except Exception:
+                # Данные остаются в буфере и будут записаны при следующей попытке
+                self.failed_flushes += 1
+                logger.error("Ошибка отложенной записи в БД.", exc_info=True)
+                return
+
+            for key in ratings:
+                self._ratings.pop(key, None)
+            for key, value in progress.items():
+                # Прогресс мог измениться, пока шла запись - тогда оставляем новое значение
+                if self._progress.get(key) == value:
+                    del self._progress[key]
+
+            self.flushes += 1
+            self.flushed_ratings += len(ratings)
+            self.flushed_progress += len(progress)
+            # Если в буфере осталась еще пачка, следующий сброс начнется сразу
+            self._maybe_wakeup()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Отложенная запись оценок включена.")
+
+    async def stop(self):
+        """Останавливает фоновую задачу и сбрасывает остаток буфера."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        # Сбрасываем остаток по пачкам, пока буфер уменьшается
+        while self._ratings or self._progress:
+            pending = len(self._ratings) + len(self._progress)
+            await self.flush()
+            if len(self._ratings) + len(self._progress) >= pending:
+                break
+        if self._ratings or self._progress:
+            logger.error(f"При остановке не удалось сохранить {len(self._ratings)} оценок "
+                         f"и {len(self._progress)} записей прогресса.")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.enabled,
+            'pending_ratings': len(self._ratings),
+            'pending_progress': len(self._progress),
+            'flushes': self.flushes,
+            'flushed_ratings': self.flushed_ratings,
+            'flushed_progress': self.flushed_progress,
+            'failed_flushes': self.failed_flushes,
+        }
+
+
+write_behind = WriteBehindBuffer(
+    async_session_factory,
+    enabled=settings.write_behind_enabled,
+    flush_interval=settings.write_behind_flush_ms / 1000,
+    max_batch=settings.write_behind_batch_size,
+)
+register_metrics('write_behind', write_behind.stats)
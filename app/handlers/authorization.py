@@ -20,6 +20,7 @@ async def start_authorization(callback: CallbackQuery, state: FSMContext):
 async def process_password(message: Message, state: FSMContext, session: AsyncSession):
     if message.text == settings.admin_password:
         user = await rq.authorize_user(session, message.from_user.id)
+        await session.commit()
         await message.answer(
             "Вы успешно авторизованы! Вам доступны расширенные команды.",
             reply_markup=ikb.get_main_menu(is_authorized=True)
@@ -1,140 +1,366 @@
+import asyncio
+import contextlib
+import itertools
 import json
 import logging
+from typing import Any, NamedTuple, Optional, Tuple
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, FSInputFile, InputMediaPhoto
 from aiogram.fsm.context import FSMContext
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.core.config import settings
 from app.database import requests as rq
+from app.database.user_cache import UserSnapshot
+from app.database.file_id_cache import file_id_cache
 from app.keyboards import inline as ikb
-from app.keyboards.callback_data import SourceSelect, ArtworkRate, Action, SearchParam, SkipAction
+from app.keyboards.callback_data import SourceSelect, ArtworkRate, Action, SearchParam, SkipAction, AlbumAction
 from app.states.user_states import PixivSearchStates
 from app.utils.pixiv import pixiv_client
+from app.utils.file_cache import file_source_cache
+from app.utils.post_store import open_post_store
+from app.utils.prefetch import search_prefetcher
+from app.utils.query_snapshot import query_snapshots
+from app.utils.image_store import image_store
 
 logger = logging.getLogger(__name__)
 
 router = Router()
 
+# Сколько постов файла проверяется за один заход в БД
+WINDOW_SIZE = 50
+# Telegram принимает в одном альбоме от 2 до 10 фото
+ALBUM_MAX_IMAGES = 10
+# Сколько раз за одно нажатие дописывать снимок запроса, если все новые посты уже оценены
+MAX_SNAPSHOT_EXTENDS = 3
+
+
+async def send_artwork(message: Message, session: AsyncSession, source_id: int, artwork_id: int,
+                       formatted_art: dict, img_idx: int, post_idx_global: int):
+    """Отправляет картинку с подписью и клавиатурой оценки."""
+    image_urls = formatted_art.get('all_image_urls', [])
+    image_url = image_urls[img_idx]
+    caption = _artwork_caption(formatted_art, f"Изображение {img_idx + 1}/{len(image_urls)}")
+    keyboard = ikb.get_rating_keyboard(source_id, artwork_id, post_idx_global)
+
+    # Новый file_id записывается после всех сетевых запросов, чтобы не держать блокировку записи на время I/O
+    file_id_changed, new_file_id = False, None
+    # aclosing: после удачной отправки генератор закрывается сразу и снимает защиту файла от вытеснения
+    async with contextlib.aclosing(_photo_sources(session, artwork_id, image_url)) as sources:
+        async for kind, photo in sources:
+            try:
+                sent = await message.answer_photo(photo=photo, caption=caption, parse_mode='HTML',
+                                                  reply_markup=keyboard)
+            except Exception as e:
+                logger.warning(f"Не удалось отправить арт {artwork_id} ({kind}): {e}")
+                if kind == 'file_id':
+                    file_id_cache.record_stale()
+                    file_id_changed, new_file_id = True, None
+                continue
+            file_id_cache.record_send(kind)
+            if kind != 'file_id':
+                # Последний элемент - самый большой из размеров, которые сделал Telegram
+                file_id_changed, new_file_id = True, sent.photo[-1].file_id
+            break
+        else:
+            logger.error(f"Не удалось отправить арт {artwork_id} ни одним способом.")
+            await message.answer(caption, parse_mode='HTML', reply_markup=keyboard)
 
-# --- Общая функция для отправки следующего арта на оценку ---
-async def send_next_art_for_rating(message: Message, session: AsyncSession, source_id: int, user_id: int):
-    source = await rq.get_source_by_id(session, source_id)
-    if not source:
-        await message.answer("Источник не найден.")
-        return
+    if file_id_changed:
+        await rq.set_telegram_file_id(session, artwork_id, new_file_id)
 
-    progress = await rq.get_user_progress(session, user_id, source_id)
-    start_post_index = progress.last_post_index if progress else 0
-    start_image_index = progress.last_image_index if progress else 0
 
-    arts_to_check = []
-    api_offset = 0
-    local_start_index = 0
+def _artwork_caption(formatted_art: dict, images_label: str) -> str:
+    create_date_str = formatted_art['create_date'].split('T')[0]
+    tags_str = ", ".join([f"#{tag}" for tag in formatted_art.get('tags', [])])
+    return (
+        f"<b>{formatted_art.get('title')}</b> ({images_label})\n"
+        f"Автор: {formatted_art.get('author')} | Дата: {create_date_str}\n"
+        f"<a href='{formatted_art.get('url')}'>Ссылка на пост Pixiv</a>\n\n"
+        f"<i>Теги: {tags_str}</i>"
+    )
 
-    if source.source_type == 'file':
-        try:
-            with open(source.details['path'], 'r', encoding='utf-8') as f:
-                raw_json = json.load(f)
-                arts_to_check = raw_json.get('illusts', raw_json)
-            local_start_index = start_post_index
-        except (FileNotFoundError, json.JSONDecodeError):
-            await message.answer("Ошибка чтения файла с артами.")
-            return
 
-    elif source.source_type == 'query':
-        query_params = source.details
-        # --- КЛЮЧЕВОЕ ИСПРАВЛЕНИЕ: Правильно вычисляем страницу и смещение ---
-        # API отдает страницы по 30 постов.
-        page_size = 30
-        # Вычисляем, какой offset нам нужно запросить у API
-        api_offset = (start_post_index // page_size) * page_size
-        # Вычисляем, с какого поста на этой странице нам нужно начать
-        local_start_index = start_post_index % page_size
-        # -----------------------------------------------------------------
-
-        pixiv_response = await pixiv_client.search(
-            query=query_params['query'], search_target=query_params['target'],
-            period=query_params['period'], rating=query_params['rating'],
-            offset=api_offset
-        )
-        if pixiv_response and pixiv_response.illusts:
-            arts_to_check = pixiv_response.illusts
-        else:
-            await message.answer(f"По вашему запросу '{source.name}' больше ничего не найдено.")
+async def _photo_sources(session: AsyncSession, artwork_id: int, image_url: str):
+    """
+    Способы отправить фото, от самого дешевого: file_id уже загруженного в Telegram фото,
+    локальная копия, уменьшенная под лимиты Telegram (оригинал скачивается с Pixiv один раз),
+    и, в крайнем случае, ссылка на Pixiv. Следующий способ готовится, только если предыдущий не сработал.
+    """
+    file_id = await rq.get_telegram_file_id(session, artwork_id)
+    if file_id:
+        yield 'file_id', file_id
+    path = await image_store.get_prepared(image_url, pixiv_client.download_image)
+    if path:
+        # Пока идет загрузка в Telegram, файл не должен быть вытеснен из кэша
+        with image_store.pinned([path]):
+            yield 'prepared', FSInputFile(path)
+    yield 'url', image_url
+
+
+async def send_post(message: Message, session: AsyncSession, state: Optional[FSMContext], user_id: int,
+                    source_id: int, artwork_id: int, formatted_art: dict, img_idx: int, post_idx_global: int):
+    """Отправляет найденный арт: альбомом, если в посте осталось несколько неоцененных картинок, иначе одним фото."""
+    images_left = len(formatted_art.get('all_image_urls', [])) - img_idx
+    if state is not None and settings.album_mode_enabled and images_left > 1:
+        if await send_album(message, session, state, user_id, source_id, formatted_art, img_idx, post_idx_global):
             return
+    await send_artwork(message, session, source_id, artwork_id, formatted_art, img_idx, post_idx_global)
+
+
+async def send_album(message: Message, session: AsyncSession, state: FSMContext, user_id: int, source_id: int,
+                     formatted_art: dict, img_idx: int, post_idx_global: int) -> bool:
+    """
+    Отправляет неоцененные картинки поста одним альбомом (send_media_group) и отдельным сообщением -
+    клавиатуру оценки. Оценки копятся в данных FSM и записываются одной пачкой после оценки всего альбома.
+    Возвращает False, если альбом не нужен или не отправился - тогда пост показывается по одной картинке.
+    """
+    image_urls = formatted_art['all_image_urls']
+    artwork_ids = await rq.upsert_artworks(session, [(post_idx_global, formatted_art)])
+    candidates = [(i, artwork_ids[(formatted_art['id'], i)]) for i in range(img_idx, len(image_urls))]
+    rated = await rq.get_rated_artwork_ids(session, user_id, [artwork_id for _, artwork_id in candidates])
+    images = [(i, artwork_id) for i, artwork_id in candidates if artwork_id not in rated][:ALBUM_MAX_IMAGES]
+    if len(images) < 2:
+        return False
+
+    # upsert выше мог начать транзакцию записи - фиксируем ее до загрузки картинок
+    await session.commit()
+
+    numbers = [i + 1 for i, _ in images]
+    caption = _artwork_caption(formatted_art, f"Изображения {numbers[0]}–{numbers[-1]} из {len(image_urls)}")
+    # В альбоме нельзя повторить отправку одной картинки, поэтому берем лучший доступный способ сразу.
+    # Сессию нельзя делить между задачами: file_id читаются по очереди, а картинки без них готовятся параллельно
+    file_ids = [await rq.get_telegram_file_id(session, artwork_id) for _, artwork_id in images]
+    prepared = iter(await asyncio.gather(*(
+        image_store.get_prepared(image_urls[i], pixiv_client.download_image)
+        for (i, _), file_id in zip(images, file_ids) if not file_id
+    )))
+    sources = []
+    paths = []
+    for (i, _), file_id in zip(images, file_ids):
+        if file_id:
+            sources.append(('file_id', file_id))
+            continue
+        path = next(prepared)
+        if path:
+            paths.append(path)
+        sources.append(('prepared', FSInputFile(path)) if path else ('url', image_urls[i]))
+    kinds = [kind for kind, _ in sources]
+    media = [InputMediaPhoto(media=photo, caption=caption if n == 0 else None, parse_mode='HTML')
+             for n, (_, photo) in enumerate(sources)]
+
+    try:
+        # Пока альбом загружается в Telegram, его файлы не должны быть вытеснены из кэша
+        with image_store.pinned(paths):
+            sent = await message.answer_media_group(media)
+    except Exception as e:
+        logger.warning(f"Не удалось отправить альбом поста {formatted_art['id']}: {e}")
+        return False
+    last_image = images[-1][0]
+    album = {
+        'source_id': source_id,
+        'post_index': post_idx_global,
+        'artwork_ids': [artwork_id for _, artwork_id in images],
+        'numbers': numbers,
+        'scores': [None] * len(images),
+        # -1 - оценка ставится сразу всем картинкам
+        'selected': -1,
+        'media_message_ids': [sent_message.message_id for sent_message in sent],
+        # Куда сдвинуть прогресс после альбома: в посте могло быть больше картинок, чем влезает в один альбом
+        'next_progress': (post_idx_global, last_image + 1) if last_image + 1 < len(image_urls)
+        else (post_idx_global + 1, 0),
+    }
+    keyboard_message = await message.answer(
+        _album_text(album), reply_markup=ikb.get_album_rating_keyboard(numbers, album['scores'], album['selected'])
+    )
+    album['keyboard_message_id'] = keyboard_message.message_id
+    await state.update_data(album=album)
+
+    # file_id записываются после всех сетевых запросов
+    for sent_message, kind, (_, artwork_id) in zip(sent, kinds, images):
+        file_id_cache.record_send(kind)
+        if kind != 'file_id' and sent_message.photo:
+            await rq.set_telegram_file_id(session, artwork_id, sent_message.photo[-1].file_id)
+    return True
+
+
+def _album_text(album: dict) -> str:
+    if album['selected'] == -1:
+        target = "всех картинок сразу"
+    else:
+        target = f"картинки {album['numbers'][album['selected']]}"
+    return f"Оценка альбома: выберите картинку или «Все» и поставьте оценку.\nСейчас выбрана оценка {target}."
+
+
+async def _discard_album_media(callback: CallbackQuery, album: dict):
+    """Удаляет фото альбома; сообщение с клавиатурой удаляет вызвавший обработчик."""
+    try:
+        await callback.bot.delete_messages(callback.message.chat.id, album['media_message_ids'])
+    except Exception as e:
+        logger.debug(f"Не удалось удалить альбом: {e}")
+
+
+class NextArt(NamedTuple):
+    """Следующий арт для оценки: что показать и куда сдвинуть прогресс."""
+    # Позиция (post_index, image_index), которую нужно записать в прогресс, или None
+    progress: Optional[Tuple[int, int]]
+    artwork_id: Optional[int] = None
+    formatted_art: Optional[dict] = None
+    image_index: int = 0
+    post_index: int = 0
+    # Если показать нечего - текст ответа пользователю
+    notice: Optional[str] = None
+    reply_markup: Any = None
+
+
+async def find_next_art(session: AsyncSession, source_id: int, user_id: int,
+                        start: Optional[Tuple[int, int]] = None, skip_artwork_ids=()) -> NextArt:
+    """
+    Находит следующий неоцененный арт, начиная с позиции start (по умолчанию - с сохраненного прогресса).
+    Ничего не записывает в прогресс и не отправляет: вызывающий записывает свои изменения вместе
+    с NextArt.progress одной транзакцией, фиксирует ее и только потом вызывает send_next_art.
+    skip_artwork_ids - картинки, оценки которых будут записаны в этой же транзакции.
+    """
+    source = await rq.get_source_by_id(session, source_id)
+    if not source:
+        return NextArt(None, notice="Источник не найден.")
+
+    if start is None:
+        progress = await rq.get_user_progress(session, user_id, source_id)
+        start_post_index = progress.last_post_index if progress else 0
+        start_image_index = progress.last_image_index if progress else 0
+        # Если ничего не найдено, прогресс остается прежним
+        not_found_progress = None
+    else:
+        start_post_index, start_image_index = start
+        not_found_progress = start
+    all_rated = f"🎉 Вы оценили все доступные арты в источнике '{source.name}'!"
+
+    if source.source_type == 'file' and rq.is_source_ingested(source):
+        # Проиндексированный файл: следующий неоцененный арт ищется одним запросом по индексу
+        found = await rq.get_next_unrated_source_image(session, user_id, source_id,
+                                                       start_post_index, start_image_index, skip_artwork_ids)
+        if not found:
+            return NextArt(not_found_progress, notice=all_rated)
+        source_image, artwork_obj = found
+        return NextArt((source_image.post_index, source_image.image_index), artwork_obj.id,
+                       artwork_obj.other_data, source_image.image_index, source_image.post_index)
+
+    if source.source_type == 'query':
+        # Запрос: следующий арт ищется в снимке выдачи, снимок дописывается, когда кончается
+        for extends in itertools.count():
+            found = await rq.get_next_unrated_source_image(session, user_id, source_id,
+                                                           start_post_index, start_image_index, skip_artwork_ids)
+            if found:
+                break
+            cursor = rq.get_query_snapshot_cursor(source)
+            if extends == MAX_SNAPSHOT_EXTENDS:
+                # Все загруженное уже оценено: не держим обработчик на десятках запросов к Pixiv,
+                # а запоминаем, докуда дошли, и предлагаем продолжить
+                return NextArt(
+                    (cursor['posts'], 0),
+                    notice=f"Просмотрено {cursor['posts']} постов запроса '{source.name}', все уже оценены. "
+                           f"Ищу дальше?",
+                    reply_markup=ikb.get_continue_evaluation_keyboard(source_id)
+                )
+            # Запросы к Pixiv идут без открытой транзакции
+            await session.commit()
+            # Если эта страница уже загружается в фоне, дожидаемся ее вместо повторного запроса
+            await search_prefetcher.wait(user_id, source_id, cursor['offset'])
+            extended = await query_snapshots.extend(source_id)
+            # Курсор сдвинут в другой сессии
+            await session.refresh(source)
+            if not extended:
+                return NextArt(not_found_progress,
+                               notice=f"По вашему запросу '{source.name}' больше ничего не найдено.")
+        source_image, artwork_obj = found
+
+        # Ближе к концу снимка начинаем грузить страницу, с которой он будет дописан
+        cursor = rq.get_query_snapshot_cursor(source)
+        if not cursor['exhausted']:
+            search_prefetcher.maybe_prefetch(
+                user_id, source_id, source.details, cursor['offset'],
+                posts_left=cursor['posts'] - 1 - source_image.post_index
+            )
+        return NextArt((source_image.post_index, source_image.image_index), artwork_obj.id,
+                       artwork_obj.other_data, source_image.image_index, source_image.post_index)
+
+    # Пары (глобальный индекс поста, formatted_art), начиная с текущего поста
+    posts = []
 
-    # Основной цикл по постам на текущей странице/в файле
-    for item_idx, art_data_raw in enumerate(arts_to_check):
-        if item_idx < local_start_index:
+    if source.source_type == 'file':
+        path = source.details['path']
+        store = await open_post_store(path)
+        if store is not None:
+            # Компактное хранилище: с диска декодируются только просматриваемые посты
+            posts = ((i, store.get(i)) for i in range(start_post_index, len(store)))
+        else:
+            try:
+                # Файл разбирается один раз и дальше берется из общего кэша
+                arts_to_check = await file_source_cache.get(path)
+            except (FileNotFoundError, json.JSONDecodeError):
+                return NextArt(not_found_progress, notice="Ошибка чтения файла с артами.")
+            posts = ((i, pixiv_client.format_illust(arts_to_check[i]))
+                     for i in range(start_post_index, len(arts_to_check)))
+
+    # Посты проверяются окнами: на каждое окно - постоянное число запросов к БД
+    posts = iter(posts)
+    while True:
+        chunk = list(itertools.islice(posts, WINDOW_SIZE))
+        if not chunk:
+            break
+        # Некорректные посты в файле хранятся как пустые записи
+        window = [post for post in chunk if post[1] is not None]
+
+        found = await rq.get_next_unrated_artwork(session, user_id, window, start_post_index, start_image_index,
+                                                  skip_artwork_ids)
+        if not found:
             continue
+        post_idx_global, img_idx, formatted_art, artwork_id = found
+        return NextArt((post_idx_global, img_idx), artwork_id, formatted_art, img_idx, post_idx_global)
 
-        # Глобальный индекс поста (для кнопок и сохранения прогресса)
-        post_idx_global = api_offset + item_idx
+    # Если мы дошли сюда, значит, все арты в файле обработаны.
+    return NextArt(not_found_progress, notice=all_rated)
 
-        formatted_art = pixiv_client.format_illust(art_data_raw)
-        image_urls = formatted_art.get('all_image_urls', [])
 
-        # Вложенный цикл по картинкам внутри поста
-        for img_idx, image_url in enumerate(image_urls):
-            # Пропускаем уже просмотренные картинки в первом посте
-            if item_idx == local_start_index and img_idx < start_image_index:
-                continue
+async def save_next_art_progress(session: AsyncSession, user_id: int, source_id: int, next_art: NextArt):
+    """Сдвигает прогресс на найденный арт (прогресс указывает на ТЕКУЩИЙ арт)."""
+    if next_art.progress is not None:
+        await rq.update_user_progress(session, user_id, source_id, *next_art.progress)
 
-            artwork_obj = await rq.get_or_create_artwork(session, formatted_art, img_idx)
-            is_rated = await rq.check_user_rating_for_artwork(session, user_id, artwork_obj.id)
-
-            if not is_rated:
-                # Сохраняем прогресс на ТЕКУЩИЙ арт перед отправкой
-                await rq.update_user_progress(session, user_id, source_id, post_idx_global, img_idx)
-
-                # Формируем подпись и отправляем
-                create_date_str = formatted_art['create_date'].split('T')[0]
-                tags_str = ", ".join([f"#{tag}" for tag in formatted_art.get('tags', [])])
-                caption = (
-                    f"<b>{artwork_obj.title}</b> (Изображение {img_idx + 1}/{len(image_urls)})\n"
-                    f"Автор: {artwork_obj.author} | Дата: {create_date_str}\n"
-                    f"<a href='{artwork_obj.url}'>Ссылка на пост Pixiv</a>\n\n"
-                    f"<i>Теги: {tags_str}</i>"
-                )
 
-                try:
-                    await message.answer_photo(
-                        photo=image_url, caption=caption, parse_mode='HTML',
-                        reply_markup=ikb.get_rating_keyboard(source_id, artwork_obj.id, post_idx_global)
-                    )
-                except Exception as e:
-                    logger.error(f"Не удалось отправить арт {artwork_obj.id}: {e}", exc_info=True)
-                    await message.answer(caption, parse_mode='HTML',
-                                         reply_markup=ikb.get_rating_keyboard(source_id, artwork_obj.id, post_idx_global))
-                return
-
-    # Если мы дошли сюда, значит, все арты на странице/в файле обработаны.
-    if source.source_type == 'query' and arts_to_check:
-        logger.debug(f"Закончилась страница для запроса '{source.name}'. Пытаюсь загрузить следующую.")
-        # Устанавливаем прогресс на начало следующей страницы
-        next_page_start_index = api_offset + len(arts_to_check)
-        await rq.update_user_progress(session, user_id, source_id, next_page_start_index, 0)
-        # Рекурсивно вызываем себя же, чтобы сразу показать арт со следующей страницы
-        await send_next_art_for_rating(message, session, source_id, user_id)
+async def send_next_art(message: Message, session: AsyncSession, state: Optional[FSMContext], user_id: int,
+                        source_id: int, next_art: NextArt):
+    """Показывает найденный арт или сообщает, почему показывать нечего. Вызывается после commit."""
+    if next_art.artwork_id is None:
+        await message.answer(next_art.notice, reply_markup=next_art.reply_markup)
         return
+    await send_post(message, session, state, user_id, source_id, next_art.artwork_id, next_art.formatted_art,
+                    next_art.image_index, next_art.post_index)
 
-    await message.answer(f"🎉 Вы оценили все доступные арты в источнике '{source.name}'!")
+
+# --- Общая функция для отправки следующего арта на оценку ---
+async def send_next_art_for_rating(message: Message, session: AsyncSession, source_id: int, user_id: int,
+                                   state: Optional[FSMContext] = None):
+    next_art = await find_next_art(session, source_id, user_id)
+    await save_next_art_progress(session, user_id, source_id, next_art)
+    # Прогресс фиксируется до отправки: загрузка картинки и запросы к Telegram идут без блокировки записи
+    await session.commit()
+    await send_next_art(message, session, state, user_id, source_id, next_art)
 
 
 # --- Обработчики для оценки из файла ---
 @router.callback_query(F.data == "evaluate_from_file")
-async def select_file_to_evaluate(callback: CallbackQuery, session: AsyncSession):
-    files = await rq.get_all_file_sources(session)
+async def select_file_to_evaluate(callback: CallbackQuery, read_session: AsyncSession):
+    files = await rq.get_all_file_sources(read_session)
     if not files:
         await callback.answer("Нет доступных файлов для оценки. Администратор должен их загрузить.", show_alert=True)
         return
 
-    # Собираем прогресс пользователя по файлам
-    user_progress = {}
-    for file_source in files:
-        progress = await rq.get_user_progress(session, callback.from_user.id, file_source.source_id)
-        if progress:
-            user_progress[file_source.source_id] = progress
+    # Собираем прогресс пользователя по всем файлам сразу
+    user_progress = await rq.get_user_progress_for_sources(
+        read_session, callback.from_user.id, [file_source.source_id for file_source in files]
+    )
 
     await callback.message.edit_text(
         "Выберите файл для начала или продолжения оценки:",
@@ -144,8 +370,8 @@ async def select_file_to_evaluate(callback: CallbackQuery, session: AsyncSession
 
 # --- FSM для оценки по запросу Pixiv ---
 @router.callback_query(F.data == "evaluate_from_query")
-async def select_or_create_pixiv_query(callback: CallbackQuery, session: AsyncSession):
-    user_queries = await rq.get_user_query_sources(session, callback.from_user.id)
+async def select_or_create_pixiv_query(callback: CallbackQuery, read_session: AsyncSession):
+    user_queries = await rq.get_user_query_sources(read_session, callback.from_user.id)
 
     # Готовим подробный текст для сообщения
     if user_queries:
@@ -251,87 +477,151 @@ async def process_period_and_finish(callback: CallbackQuery, callback_data: Sear
 
     source_name = f"Запрос: {data['keywords'][:30]}..."
     new_source = await rq.add_query_source(session, source_name, query_details, callback.from_user.id)
+    await session.commit()
 
     await callback.message.edit_text(
         f"Новый запрос '{source_name}' успешно создан! Начинаю оценку...",
         reply_markup=None
     )
     # Запускаем оценку по новосозданному источнику
-    await send_next_art_for_rating(callback.message, session, new_source.source_id, callback.from_user.id)
+    await send_next_art_for_rating(callback.message, session, new_source.source_id, callback.from_user.id, state)
 
 
 # --- Общие обработчики для процесса оценки ---
 @router.callback_query(SourceSelect.filter())
-async def start_evaluation(callback: CallbackQuery, callback_data: SourceSelect, session: AsyncSession):
+async def start_evaluation(callback: CallbackQuery, callback_data: SourceSelect, session: AsyncSession,
+                           state: FSMContext):
     await callback.message.delete()
-    await send_next_art_for_rating(callback.message, session, callback_data.source_id, callback.from_user.id)
+    await send_next_art_for_rating(callback.message, session, callback_data.source_id, callback.from_user.id, state)
 
-async def advance_and_send_next(callback: CallbackQuery, session: AsyncSession, source_id: int):
+async def advance_and_send_next(callback: CallbackQuery, session: AsyncSession, source_id: int,
+                                state: Optional[FSMContext] = None):
     """Вспомогательная функция для перехода к следующему арту."""
     progress = await rq.get_user_progress(session, callback.from_user.id, source_id)
     if not progress:
         return
 
-    # Рассчитываем следующий шаг
-    source = await rq.get_source_by_id(session, source_id)
-    if source.source_type == 'file':
-        # Просто переходим к следующей картинке, логика в send_next_art_for_rating найдет ее
-        await rq.update_user_progress(session, callback.from_user.id, source_id, progress.last_post_index, progress.last_image_index + 1)
-    elif source.source_type == 'query':
-        # Для запроса нужно проверить, не вышли ли мы за пределы страницы
-        # Это сложная логика, пока просто увеличим индекс картинки
-        await rq.update_user_progress(session, callback.from_user.id, source_id, progress.last_post_index, progress.last_image_index + 1)
+    # Переходим к следующей картинке: find_next_art сам найдет ее и в файле, и в снимке запроса
+    next_art = await find_next_art(session, source_id, callback.from_user.id,
+                                   start=(progress.last_post_index, progress.last_image_index + 1))
+    await save_next_art_progress(session, callback.from_user.id, source_id, next_art)
+    await session.commit()
 
     await callback.message.delete()
-    await send_next_art_for_rating(callback.message, session, source_id, callback.from_user.id)
+    await send_next_art(callback.message, session, state, callback.from_user.id, source_id, next_art)
 
 
 @router.callback_query(ArtworkRate.filter())
-async def process_artwork_rating(callback: CallbackQuery, callback_data: ArtworkRate, session: AsyncSession):
-    # 1. Сохраняем оценку
+async def process_artwork_rating(callback: CallbackQuery, callback_data: ArtworkRate, session: AsyncSession,
+                                 state: FSMContext):
+    user_id, source_id = callback.from_user.id, callback_data.source_id
+    # 1. Находим следующий арт: оцениваемая картинка пропускается, хотя ее оценка еще не записана
+    next_art = await find_next_art(session, source_id, user_id, skip_artwork_ids=(callback_data.artwork_id,))
+    # 2. Оценка и прогресс фиксируются одной транзакцией до сетевых запросов:
+    # блокировка записи SQLite не должна ждать Telegram
     await rq.add_rating(
-        session, user_id=callback.from_user.id, artwork_id=callback_data.artwork_id,
-        source_id=callback_data.source_id, score=callback_data.score
+        session, user_id=user_id, artwork_id=callback_data.artwork_id,
+        source_id=source_id, score=callback_data.score
     )
-    # 2. Удаляем старое сообщение и просим показать следующий арт
+    await save_next_art_progress(session, user_id, source_id, next_art)
+    await session.commit()
+    # 3. Удаляем старое сообщение и показываем следующий арт
     await callback.message.delete()
-    await send_next_art_for_rating(callback.message, session, callback_data.source_id, callback.from_user.id)
+    await send_next_art(callback.message, session, state, user_id, source_id, next_art)
 
 
 @router.callback_query(SkipAction.filter(F.action == 'image'))
-async def skip_image_handler(callback: CallbackQuery, callback_data: SkipAction, session: AsyncSession):
+async def skip_image_handler(callback: CallbackQuery, callback_data: SkipAction, session: AsyncSession,
+                             state: FSMContext):
     await callback.answer("Картинка пропущена")
 
     progress = await rq.get_user_progress(session, callback.from_user.id, callback_data.source_id)
-    if progress:
-        await rq.update_user_progress(session, callback.from_user.id, callback_data.source_id, progress.last_post_index,
-                                      progress.last_image_index + 1)
+    start = (progress.last_post_index, progress.last_image_index + 1) if progress else None
+    next_art = await find_next_art(session, callback_data.source_id, callback.from_user.id, start=start)
+    await save_next_art_progress(session, callback.from_user.id, callback_data.source_id, next_art)
+    await session.commit()
 
     await callback.message.delete()
-    await send_next_art_for_rating(callback.message, session, callback_data.source_id, callback.from_user.id)
+    await send_next_art(callback.message, session, state, callback.from_user.id, callback_data.source_id, next_art)
 
 
 @router.callback_query(SkipAction.filter(F.action == 'post'))
-async def skip_post_handler(callback: CallbackQuery, callback_data: SkipAction, session: AsyncSession):
+async def skip_post_handler(callback: CallbackQuery, callback_data: SkipAction, session: AsyncSession,
+                            state: FSMContext):
     await callback.answer("Пост пропущен")
 
-    # Устанавливаем прогресс на начало СЛЕДУЮЩЕГО поста
-    await rq.update_user_progress(
-        session,
-        user_id=callback.from_user.id,
-        source_id=callback_data.source_id,
-        post_index=callback_data.post_idx + 1,  # Переходим к следующему посту
-        image_index=0  # Начинаем с первой картинки
-    )
+    # Ищем со СЛЕДУЮЩЕГО поста, с первой картинки
+    next_art = await find_next_art(session, callback_data.source_id, callback.from_user.id,
+                                   start=(callback_data.post_idx + 1, 0))
+    await save_next_art_progress(session, callback.from_user.id, callback_data.source_id, next_art)
+    await session.commit()
 
     await callback.message.delete()
-    await send_next_art_for_rating(callback.message, session, callback_data.source_id, callback.from_user.id)
+    await send_next_art(callback.message, session, state, callback.from_user.id, callback_data.source_id, next_art)
+
+@router.callback_query(AlbumAction.filter())
+async def album_action_handler(callback: CallbackQuery, callback_data: AlbumAction, session: AsyncSession,
+                               state: FSMContext):
+    album = (await state.get_data()).get('album')
+    if not album or album['keyboard_message_id'] != callback.message.message_id:
+        await callback.answer("Этот альбом уже оценен.")
+        return
+
+    scores = album['scores']
+    if callback_data.action == 'select':
+        album['selected'] = callback_data.value
+    elif callback_data.action == 'rate':
+        if album['selected'] == -1:
+            # "Все": оценка достается всем картинкам, которым ее еще не поставили по отдельности
+            album['scores'] = [score if score is not None else callback_data.value for score in scores]
+        else:
+            scores[album['selected']] = callback_data.value
+            # Сразу переходим к следующей неоцененной картинке
+            unrated = [i for i, score in enumerate(scores) if score is None]
+            album['selected'] = next((i for i in unrated if i > album['selected']), unrated[0] if unrated else -1)
+
+    finished = callback_data.action in ('done', 'skip') or all(score is not None for score in album['scores'])
+    if not finished:
+        await state.update_data(album=album)
+        await callback.message.edit_text(
+            _album_text(album),
+            reply_markup=ikb.get_album_rating_keyboard(album['numbers'], album['scores'], album['selected'])
+        )
+        await callback.answer()
+        return
+
+    scores = {}
+    if callback_data.action == 'skip':
+        next_progress = (album['post_index'] + 1, 0)
+    else:
+        scores = {artwork_id: score for artwork_id, score in zip(album['artwork_ids'], album['scores'])
+                  if score is not None}
+        next_progress = album['next_progress']
+    next_art = await find_next_art(session, album['source_id'], callback.from_user.id,
+                                   start=next_progress, skip_artwork_ids=scores)
+    # Все оценки альбома записываются одной пачкой
+    await rq.add_ratings(session, callback.from_user.id, album['source_id'], scores)
+    await save_next_art_progress(session, callback.from_user.id, album['source_id'], next_art)
+    # Оценки и прогресс альбома фиксируются вместе, до ответов Telegram
+    await session.commit()
+    await state.update_data(album=None)
+    await callback.answer("Оценки сохранены" if scores else "Пост пропущен")
+
+    await _discard_album_media(callback, album)
+    await callback.message.delete()
+    await send_next_art(callback.message, session, state, callback.from_user.id, album['source_id'], next_art)
+
 
 @router.callback_query(Action.filter(F.name == "stop_eval"))
-async def stop_evaluation(callback: CallbackQuery, session: AsyncSession):
+async def stop_evaluation(callback: CallbackQuery, user: UserSnapshot, state: FSMContext):
     await callback.answer("Оценка прервана")
+    search_prefetcher.cancel(callback.from_user.id)
+
+    album = (await state.get_data()).get('album')
+    if album:
+        await state.update_data(album=None)
+        await _discard_album_media(callback, album)
 
-    user = await rq.get_or_create_user(session, callback.from_user.id)
     await callback.message.delete()
     await callback.message.answer("Вы можете вернуться к оценке позже.",
                                   reply_markup=ikb.get_main_menu(user.is_authorized))
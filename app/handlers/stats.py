@@ -0,0 +1,75 @@
+# app/handlers/stats.py
+import html
+from typing import Union
+
+from aiogram import Router, F
+from aiogram.filters import Command
+from aiogram.types import Message, CallbackQuery
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import requests as rq
+from app.handlers.user_content import is_authorized_filter
+from app.keyboards import inline as ikb
+from app.keyboards.callback_data import StatsSource
+
+router = Router()
+
+router.message.filter(is_authorized_filter)
+router.callback_query.filter(is_authorized_filter)
+
+# Сколько картинок показывать в топе источника
+LEADERBOARD_SIZE = 10
+HISTOGRAM_BARS = " ▁▂▃▄▅▆▇█"
+
+
+def format_histogram(histogram: list) -> str:
+    """Гистограмма 1..10 одной строкой из блоков разной высоты."""
+    peak = max(histogram) or 1
+    return "".join(HISTOGRAM_BARS[round(count / peak * (len(HISTOGRAM_BARS) - 1))] for count in histogram)
+
+
+# Все цифры ниже берутся из агрегатов (artwork_scores/source_scores), таблица оценок не сканируется
+@router.message(Command("stats"))
+@router.callback_query(F.data == "stats_menu")
+async def stats_menu_handler(event: Union[Message, CallbackQuery], read_session: AsyncSession):
+    source_scores = await rq.get_source_scores(read_session)
+    message = event.message if isinstance(event, CallbackQuery) else event
+    if isinstance(event, CallbackQuery):
+        await event.answer()
+
+    if not source_scores:
+        await message.answer("Пока нет ни одной оценки.")
+        return
+
+    await message.answer(
+        "Выберите источник, чтобы посмотреть лучшие арты:",
+        reply_markup=ikb.get_stats_sources_keyboard(source_scores)
+    )
+
+
+@router.callback_query(StatsSource.filter())
+async def source_leaderboard_handler(callback: CallbackQuery, callback_data: StatsSource,
+                                     read_session: AsyncSession):
+    source = await rq.get_source_by_id(read_session, callback_data.source_id)
+    source_score = await rq.get_source_score(read_session, callback_data.source_id)
+    if not source or not source_score:
+        await callback.answer("По этому источнику пока нет оценок.", show_alert=True)
+        return
+
+    leaderboard = await rq.get_source_leaderboard(read_session, callback_data.source_id, limit=LEADERBOARD_SIZE)
+
+    lines = [
+        f"🏆 <b>{html.escape(source.name)}</b>",
+        f"Оценок: {source_score.count}, средняя: {source_score.mean:.2f} ± {source_score.stddev:.2f}",
+        f"1 <code>{format_histogram(source_score.histogram)}</code> 10",
+        "",
+    ]
+    for place, (artwork_score, artwork) in enumerate(leaderboard, 1):
+        title = html.escape(artwork.title or str(artwork.pixiv_id))
+        lines.append(
+            f"{place}. <a href='{artwork.url}'>{title}</a> "
+            f"#{artwork.image_index + 1} — {artwork_score.mean:.2f} ({artwork_score.count})"
+        )
+
+    await callback.message.edit_text("\n".join(lines), parse_mode='HTML', disable_web_page_preview=True)
+    await callback.answer()
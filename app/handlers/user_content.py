@@ -1,31 +1,34 @@
 # app/handlers/user_content.py
 import os
 import json
-import csv
-import io
-from typing import Union, List
+from typing import Union, Optional
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, BufferedInputFile
+from aiogram.filters import Command
+from aiogram.types import Message, CallbackQuery, FSInputFile
 from aiogram.fsm.context import FSMContext
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database import requests as rq
-from app.database.models import Rating
 from app.keyboards import inline as ikb
 from app.keyboards.callback_data import Action
 from app.states.user_states import UserContentStates, ExportStates
 from app.database.engine import DATA_DIR
+from app.database.user_cache import UserSnapshot
+from app.utils.file_cache import file_source_cache
+from app.utils.ingestion import start_ingestion, cancel_ingestion
+from app.utils.post_store import remove_post_store
+from app.utils.metrics import format_metrics
+from app.utils.export import export_ratings_csv, get_full_export, cleanup_export
 
 router = Router()
 
 
-async def is_authorized_filter(event: Union[Message, CallbackQuery], session: AsyncSession):
+async def is_authorized_filter(event: Union[Message, CallbackQuery], user: Optional[UserSnapshot]):
     """
     Проверяет, авторизован ли пользователь.
-    Работает и для сообщений, и для колбэков.
+    Работает и для сообщений, и для колбэков. Снимок user подставляет UserMiddleware из кэша.
     """
-    user = await rq.get_or_create_user(session, event.from_user.id)
-    return user.is_authorized
+    return user is not None and user.is_authorized
 
 
 # Применяем фильтр ко всем хендлерам в этом роутере
@@ -33,33 +36,53 @@ router.message.filter(is_authorized_filter)
 router.callback_query.filter(is_authorized_filter)
 
 
-# --- Вспомогательная функция для генерации CSV ---
-async def generate_ratings_csv(ratings: List[Rating], filename: str) -> BufferedInputFile:
-    """Генерирует CSV файл из списка оценок."""
-    output = io.StringIO()
-    writer = csv.writer(output)
-
-    # Заголовки CSV
-    writer.writerow([
-        'user_id', 'username', 'artwork_id', 'title', 'author',
-        'artwork_url', 'user_score', 'source_name', 'rated_at'
-    ])
-
-    for rating in ratings:
-        writer.writerow([
-            rating.user.user_id,
-            rating.user.username,
-            rating.artwork.pixiv_id,  # Используем pixiv_id для идентификации
-            rating.artwork.title,
-            rating.artwork.author,
-            rating.artwork.url,
-            rating.score,
-            rating.source.name if rating.source else "Удаленный источник",
-            rating.created_at.strftime("%Y-%m-%d %H:%M:%S")
-        ])
-
-    output.seek(0)
-    return BufferedInputFile(output.getvalue().encode('utf-8'), filename=filename)
+# --- Вспомогательная функция для отправки экспорта ---
+async def send_ratings_export(message: Message, session: AsyncSession, read_session: AsyncSession,
+                              requester_id: int, stem: str, user_id: Optional[int] = None,
+                              delta: bool = False) -> bool:
+    """
+    Выгружает оценки в сжатый CSV и отправляет его (при необходимости - несколькими частями).
+    Полная выгрузка берется из кэша на диске, если с прошлого раза не появилось новых оценок.
+    В режиме delta отправляются только оценки, добавленные после прошлого экспорта этого пользователя.
+    Возвращает False, если выгружать нечего.
+    """
+    target = 'all' if user_id is None else f'user:{user_id}'
+    # Все чтения ниже идут в одной транзакции read_session, поэтому видят один и тот же снимок
+    max_rating_id = await rq.get_max_rating_id(read_session, user_id)
+    if max_rating_id is None:
+        return False
+
+    directory = None
+    if delta:
+        since_rating_id = await rq.get_export_watermark(session, requester_id, target) or 0
+        if max_rating_id <= since_rating_id:
+            return False
+        directory, paths, _ = await export_ratings_csv(
+            read_session, stem, user_id=user_id,
+            since_rating_id=since_rating_id, until_rating_id=max_rating_id
+        )
+        stem = f"{stem}_since_{since_rating_id}"
+    else:
+        scope = 'all' if user_id is None else f'user_{user_id}'
+        paths = await get_full_export(read_session, scope, user_id, max_rating_id)
+
+    sent_parts = 0
+    try:
+        for part_number, path in enumerate(paths, 1):
+            filename = f"{stem}.csv.gz" if len(paths) == 1 else f"{stem}_part{part_number}.csv.gz"
+            await message.answer_document(FSInputFile(path, filename=filename))
+            sent_parts += 1
+    finally:
+        if directory:
+            cleanup_export(directory)
+    if not paths:
+        return False
+
+    # Следующий "только новые" начнется с этого места. Водяной знак сдвигается, только если
+    # дошли все части, иначе неотправленные оценки не попали бы и в следующую выгрузку
+    if sent_parts == len(paths):
+        await rq.set_export_watermark(session, requester_id, target, max_rating_id)
+    return True
 
 # --- Upload ---
 @router.callback_query(F.data == "upload_file")
@@ -82,15 +105,20 @@ async def process_upload(message: Message, state: FSMContext, session: AsyncSess
     filepath = os.path.join(DATA_DIR, document.file_name)
     await message.bot.download(document, destination=filepath)
 
-    await rq.add_file_source(session, document.file_name, filepath, message.from_user.id)
+    source = await rq.add_file_source(session, document.file_name, filepath, message.from_user.id)
+    # Фиксируем источник до запуска индексации: фоновая задача работает в своей транзакции
+    await session.commit()
     await message.answer(f"Файл '{document.file_name}' успешно загружен и готов к оценке.")
     await state.clear()
 
+    # Разбираем файл в фоне, прогресс будет приходить отдельным сообщением
+    start_ingestion(message.bot, source.source_id, filepath, document.file_name, chat_id=message.chat.id)
+
 
 # --- Delete ---
 @router.callback_query(F.data == "delete_file")
-async def select_file_to_delete(callback: CallbackQuery, session: AsyncSession):
-    user_files = await rq.get_user_file_sources(session, callback.from_user.id)
+async def select_file_to_delete(callback: CallbackQuery, read_session: AsyncSession):
+    user_files = await rq.get_user_file_sources(read_session, callback.from_user.id)
     if not user_files:
         await callback.answer("Вы еще не загрузили ни одного файла.", show_alert=True)
         return
@@ -109,7 +137,11 @@ async def confirm_delete(callback: CallbackQuery, callback_data: Action, session
         return
 
     # Удаляем файл с диска
+    cancel_ingestion(source.source_id)
     filepath = source.details.get('path')
+    if filepath:
+        file_source_cache.invalidate(filepath)
+        remove_post_store(filepath)
     if filepath and os.path.exists(filepath):
         try:
             os.remove(filepath)
@@ -118,13 +150,14 @@ async def confirm_delete(callback: CallbackQuery, callback_data: Action, session
 
     # Удаляем запись из БД
     await rq.delete_source_by_owner(session, callback_data.source_id, callback.from_user.id)
+    await session.commit()
     await callback.message.edit_text(f"Файл '{source.name}' был успешно удален.")
 
 
 # --- My Stuff ---
 @router.callback_query(F.data == "my_stuff")
-async def my_stuff_handler(callback: CallbackQuery, session: AsyncSession):
-    files = await rq.get_user_file_sources(session, callback.from_user.id)
+async def my_stuff_handler(callback: CallbackQuery, read_session: AsyncSession):
+    files = await rq.get_user_file_sources(read_session, callback.from_user.id)
     if not files:
         await callback.answer("У вас пока нет загруженных файлов.", show_alert=True)
         return
@@ -149,39 +182,43 @@ async def export_data_handler(callback: CallbackQuery):
 
 
 # 2. Экспорт своих оценок
-@router.callback_query(F.data == "export_mine")
-async def export_mine_handler(callback: CallbackQuery, session: AsyncSession):
+@router.callback_query(F.data.in_({"export_mine", "export_mine_delta"}))
+async def export_mine_handler(callback: CallbackQuery, session: AsyncSession, read_session: AsyncSession):
+    delta = callback.data.endswith('_delta')
     await callback.answer("Начинаю экспорт ваших оценок...")
-    ratings = await rq.get_user_ratings_for_export(session, callback.from_user.id)
+    sent = await send_ratings_export(callback.message, session, read_session, callback.from_user.id,
+                                     f'export_my_{callback.from_user.id}', user_id=callback.from_user.id,
+                                     delta=delta)
 
-    if not ratings:
-        await callback.message.answer("У вас пока нет оценок для экспорта.")
+    if not sent:
+        await callback.message.answer("С прошлого экспорта новых оценок нет." if delta
+                                      else "У вас пока нет оценок для экспорта.")
         return
 
-    csv_file = await generate_ratings_csv(ratings, f'export_my_{callback.from_user.id}.csv')
-    await callback.message.answer_document(csv_file)
     await callback.message.delete()  # Удаляем меню
 
 
 # 3. Экспорт всех оценок
-@router.callback_query(F.data == "export_all")
-async def export_all_handler(callback: CallbackQuery, session: AsyncSession):
+@router.callback_query(F.data.in_({"export_all", "export_all_delta"}))
+async def export_all_handler(callback: CallbackQuery, session: AsyncSession, read_session: AsyncSession):
+    delta = callback.data.endswith('_delta')
     await callback.answer("Начинаю экспорт ВСЕХ оценок...")
-    ratings = await rq.get_all_ratings_for_export(session)
+    sent = await send_ratings_export(callback.message, session, read_session, callback.from_user.id,
+                                     'export_all_users', delta=delta)
 
-    if not ratings:
-        await callback.message.answer("В базе данных еще нет ни одной оценки.")
+    if not sent:
+        await callback.message.answer("С прошлого экспорта новых оценок нет." if delta
+                                      else "В базе данных еще нет ни одной оценки.")
         return
 
-    csv_file = await generate_ratings_csv(ratings, 'export_all_users.csv')
-    await callback.message.answer_document(csv_file)
     await callback.message.delete()
 
 
 # 4. Диалог для экспорта по ID
-@router.callback_query(F.data == "export_specific_user")
+@router.callback_query(F.data.in_({"export_specific_user", "export_specific_user_delta"}))
 async def export_specific_user_start(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ExportStates.waiting_for_user_id)
+    await state.update_data(delta=callback.data.endswith('_delta'))
     await callback.message.edit_text(
         "Пожалуйста, введите Telegram ID пользователя, оценки которого вы хотите экспортировать.",
         reply_markup=ikb.get_cancel_fsm_keyboard()
@@ -190,20 +227,26 @@ async def export_specific_user_start(callback: CallbackQuery, state: FSMContext)
 
 
 @router.message(ExportStates.waiting_for_user_id)
-async def export_specific_user_process(message: Message, state: FSMContext, session: AsyncSession):
+async def export_specific_user_process(message: Message, state: FSMContext, session: AsyncSession,
+                                       read_session: AsyncSession):
     if not message.text.isdigit():
         await message.answer("Ошибка. Telegram ID должен быть числом. Попробуйте еще раз.")
         return
 
     user_id = int(message.text)
+    delta = (await state.get_data()).get('delta', False)
     await state.clear()
 
     await message.answer(f"Начинаю экспорт оценок пользователя {user_id}...")
-    ratings = await rq.get_user_ratings_for_export(session, user_id)
+    sent = await send_ratings_export(message, session, read_session, message.from_user.id,
+                                     f'export_user_{user_id}', user_id=user_id, delta=delta)
+
+    if not sent:
+        await message.answer(f"Новых оценок пользователя {user_id} с прошлого экспорта нет." if delta
+                             else f"Не найдено оценок для пользователя с ID {user_id}.")
 
-    if not ratings:
-        await message.answer(f"Не найдено оценок для пользователя с ID {user_id}.")
-        return
 
-    csv_file = await generate_ratings_csv(ratings, f'export_user_{user_id}.csv')
-    await message.answer_document(csv_file)
+# --- Metrics ---
+@router.message(Command("metrics"))
+async def metrics_handler(message: Message):
+    await message.answer(format_metrics(), parse_mode='HTML')
@@ -26,3 +26,12 @@ class SkipAction(CallbackData, prefix="skip"):
 class SearchParam(CallbackData, prefix="search_p"):
     param: str  # 'target', 'rating', 'period'
     value: str
+
+
+class StatsSource(CallbackData, prefix="stats_src"):
+    source_id: int
+
+
+class AlbumAction(CallbackData, prefix="album"):
+    action: str  # 'select', 'rate', 'done' или 'skip'
+    value: int = 0  # Для 'select' - номер картинки в альбоме (-1 - все сразу), для 'rate' - оценка
@@ -1,6 +1,6 @@
 # app/keyboards/inline.py
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from .callback_data import SourceSelect, ArtworkRate, Action, SearchParam, SkipAction
+from .callback_data import SourceSelect, ArtworkRate, Action, SearchParam, SkipAction, StatsSource, AlbumAction
 
 
 def get_main_menu(is_authorized: bool = False):
@@ -14,6 +14,7 @@ def get_main_menu(is_authorized: bool = False):
             [InlineKeyboardButton(text="📂 Мои данные", callback_data="my_stuff")],
             [InlineKeyboardButton(text="🗑️ Удалить файл", callback_data="delete_file")],
             [InlineKeyboardButton(text="📊 Экспорт оценок", callback_data="export_data")],
+            [InlineKeyboardButton(text="🏆 Лучшие арты", callback_data="stats_menu")],
         ])
     else:
         buttons.append([InlineKeyboardButton(text="🔑 Авторизация", callback_data="authorize")])
@@ -76,6 +77,14 @@ async def get_files_to_delete(files: list):
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+def get_continue_evaluation_keyboard(source_id: int):
+    """Продолжение оценки источника, когда поиск следующего арта прерван на середине."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="▶️ Продолжить", callback_data=SourceSelect(source_id=source_id).pack())],
+        [InlineKeyboardButton(text="🚫 Прекратить оценку", callback_data=Action(name="stop_eval").pack())],
+    ])
+
+
 def get_cancel_fsm_keyboard():
     """Клавиатура для отмены текущего состояния (диалога)."""
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -155,9 +164,61 @@ async def get_queries_menu(queries: list):
 
 def get_export_options_keyboard():
     buttons = [
-        [InlineKeyboardButton(text="📊 Мои оценки", callback_data="export_mine")],
-        [InlineKeyboardButton(text="👤 Оценки пользователя по ID", callback_data="export_specific_user")],
-        [InlineKeyboardButton(text="🌐 Все оценки (всех пользователей)", callback_data="export_all")],
+        # Справа - только оценки, появившиеся после прошлого экспорта
+        [InlineKeyboardButton(text="📊 Мои оценки", callback_data="export_mine"),
+         InlineKeyboardButton(text="🆕 Только новые", callback_data="export_mine_delta")],
+        [InlineKeyboardButton(text="👤 Оценки пользователя по ID", callback_data="export_specific_user"),
+         InlineKeyboardButton(text="🆕 Только новые", callback_data="export_specific_user_delta")],
+        [InlineKeyboardButton(text="🌐 Все оценки (всех пользователей)", callback_data="export_all"),
+         InlineKeyboardButton(text="🆕 Только новые", callback_data="export_all_delta")],
         [InlineKeyboardButton(text="❌ Отмена", callback_data=Action(name="cancel_fsm").pack())],
     ]
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
\ No newline at end of file
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def get_stats_sources_keyboard(source_scores: list):
+    """Кнопки источников для просмотра топа. source_scores - пары (SourceScore, Source)."""
+    buttons = []
+    for source_score, source in source_scores:
+        icon = "📁" if source.source_type == 'file' else "🔍"
+        buttons.append([
+            InlineKeyboardButton(
+                text=f"{icon} {source.name[:30]} ({source_score.count})",
+                callback_data=StatsSource(source_id=source.source_id).pack()
+            )
+        ])
+    buttons.append([InlineKeyboardButton(text="❌ Отмена", callback_data=Action(name="cancel_fsm").pack())])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def get_album_rating_keyboard(image_numbers: list, scores: list, selected: int):
+    """
+    Компактная клавиатура оценки альбома: выбор картинки (или всех сразу) и общий ряд оценок.
+    image_numbers - номера картинок в посте, scores - уже выставленные оценки (None - нет),
+    selected - индекс выбранной картинки в альбоме или -1 (все).
+    """
+    def mark(text: str, is_selected: bool) -> str:
+        return f"• {text} •" if is_selected else text
+
+    select_buttons = [
+        InlineKeyboardButton(text=mark("Все", selected == -1),
+                             callback_data=AlbumAction(action='select', value=-1).pack())
+    ]
+    for i, (number, score) in enumerate(zip(image_numbers, scores)):
+        text = f"{number}: {score}" if score is not None else str(number)
+        select_buttons.append(InlineKeyboardButton(text=mark(text, selected == i),
+                                                   callback_data=AlbumAction(action='select', value=i).pack()))
+
+    buttons = [select_buttons[i:i + 6] for i in range(0, len(select_buttons), 6)]
+    buttons.extend([
+        [InlineKeyboardButton(text=str(i), callback_data=AlbumAction(action='rate', value=i).pack())
+         for i in range(1, 6)],
+        [InlineKeyboardButton(text=str(i), callback_data=AlbumAction(action='rate', value=i).pack())
+         for i in range(6, 11)],
+        [
+            InlineKeyboardButton(text="✅ Готово", callback_data=AlbumAction(action='done').pack()),
+            InlineKeyboardButton(text="⏩ Пропустить пост", callback_data=AlbumAction(action='skip').pack()),
+        ],
+        [InlineKeyboardButton(text="🚫 Прекратить оценку", callback_data=Action(name="stop_eval").pack())],
+    ])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
@@ -0,0 +1,141 @@
+import asyncio
+import csv
+import gzip
+import io
+import logging
+import os
+import shutil
+import tempfile
+from typing import List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import requests as rq
+from app.database.engine import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+# Лимит Telegram Bot API на отправку файла - 50 МБ; оставляем запас на буфер gzip
+PART_SIZE_LIMIT = 48 * 1024 * 1024
+# Как часто (в строках) проверять размер текущей части
+SIZE_CHECK_ROWS = 500
+
+# Здесь лежат готовые полные выгрузки, пока в таблице не появятся новые оценки
+EXPORT_CACHE_DIR = os.path.join(DATA_DIR, 'exports')
+
+CSV_HEADER = [
+    'user_id', 'username', 'artwork_id', 'title', 'author',
+    'artwork_url', 'user_score', 'source_name', 'rated_at'
+]
+
+
+class _GzipCsvParts:
+    """
+    Пишет строки CSV в сжатые файлы, начиная новую часть, как только текущая
+    приближается к лимиту Telegram. Каждая часть - самостоятельный .csv.gz с заголовком.
+    """
+
+    def __init__(self, directory: str, stem: str, part_limit: int):
+        self.directory = directory
+        self.stem = stem
+        self.part_limit = part_limit
+        self.paths: List[str] = []
+        self.rows = 0
+        self._raw = None
+        self._text = None
+        self._writer = None
+
+    def _open_part(self):
+        path = os.path.join(self.directory, f"{self.stem}_{len(self.paths) + 1:03d}.csv.gz")
+        self.paths.append(path)
+        self._raw = open(path, 'wb')
+        gz = gzip.GzipFile(fileobj=self._raw, mode='wb')
+        self._text = io.TextIOWrapper(gz, encoding='utf-8', newline='')
+        self._writer = csv.writer(self._text)
+        self._writer.writerow(CSV_HEADER)
+
+    def _close_part(self):
+        if self._text is not None:
+            self._text.close()
+            self._raw.close()
+            self._text = self._raw = self._writer = None
+
+    def write_rows(self, rows):
+        """Записывает пачку строк. Выполняется в отдельном потоке, чтобы не блокировать event loop."""
+        for user_id, username, pixiv_id, title, author, url, score, source_name, created_at in rows:
+            if self._writer is None:
+                self._open_part()
+            self._writer.writerow([
+                user_id,
+                username,
+                pixiv_id,  # Используем pixiv_id для идентификации
+                title,
+                author,
+                url,
+                score,
+                source_name if source_name is not None else "Удаленный источник",
+                created_at.strftime("%Y-%m-%d %H:%M:%S") if created_at else ""
+            ])
+            self.rows += 1
+            # Размер проверяем по уже сжатым байтам на диске
+            if self.rows % SIZE_CHECK_ROWS == 0 and self._raw.tell() >= self.part_limit:
+                self._close_part()
+
+    def close(self):
+        self._close_part()
+
+
+async def export_ratings_csv(session: AsyncSession, stem: str, user_id: Optional[int] = None,
+                             since_rating_id: Optional[int] = None, until_rating_id: Optional[int] = None,
+                             directory: Optional[str] = None) -> Tuple[str, List[str], int]:
+    """
+    Потоково выгружает оценки в сжатые CSV.
+    Память не зависит от размера таблицы: в ней одновременно только одна пачка строк.
+    Возвращает (папка, пути к частям, число строк). Временную папку нужно удалить через cleanup_export.
+    """
+    directory = directory or tempfile.mkdtemp(prefix='export_')
+    parts = _GzipCsvParts(directory, stem, PART_SIZE_LIMIT)
+    try:
+        async for rows in rq.stream_ratings_for_export(session, user_id=user_id, since_rating_id=since_rating_id,
+                                                       until_rating_id=until_rating_id):
+            await asyncio.to_thread(parts.write_rows, rows)
+    except Exception:
+        parts.close()
+        cleanup_export(directory)
+        raise
+    parts.close()
+    return directory, parts.paths, parts.rows
+
+
+async def get_full_export(session: AsyncSession, scope: str, user_id: Optional[int],
+                          max_rating_id: int) -> List[str]:
+    """
+    Возвращает полную выгрузку из кэша на диске, а если с прошлого раза появились
+    новые оценки (изменился max_rating_id) - строит ее заново и заменяет старую.
+    scope - 'all' или 'user_<id>'.
+    """
+    directory = os.path.join(EXPORT_CACHE_DIR, f"{scope}_{max_rating_id}")
+    if not os.path.isdir(directory):
+        os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+        build_dir = tempfile.mkdtemp(prefix=f"{scope}_", dir=EXPORT_CACHE_DIR)
+        await export_ratings_csv(session, scope, user_id=user_id, until_rating_id=max_rating_id,
+                                 directory=build_dir)
+        try:
+            os.rename(build_dir, directory)
+        except OSError:
+            # Ту же выгрузку параллельно уже собрал другой запрос
+            cleanup_export(build_dir)
+        logger.info(f"Полная выгрузка {scope} до оценки {max_rating_id} сохранена в кэш.")
+
+        # Устаревшие выгрузки той же цели больше не понадобятся
+        for name in os.listdir(EXPORT_CACHE_DIR):
+            old = os.path.join(EXPORT_CACHE_DIR, name)
+            if name.startswith(f"{scope}_") and old != directory and os.path.isdir(old) \
+                    and name[len(scope) + 1:].isdigit():
+                cleanup_export(old)
+
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory))
+
+
+def cleanup_export(directory: str):
+    shutil.rmtree(directory, ignore_errors=True)
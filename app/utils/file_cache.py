@@ -0,0 +1,122 @@
+import asyncio
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Any
+
+from pixivpy_async.utils import JsonDict
+
+from app.core.config import settings
+from app.utils.metrics import register_metrics
+
+logger = logging.getLogger(__name__)
+
+# Во сколько раз разобранный в JsonDict файл больше JSON на диске. Замерено tracemalloc
+# на выгрузках Pixiv: 3.5-4.1 в зависимости от доли не-ASCII текста; берем с запасом
+PARSED_SIZE_FACTOR = 4
+
+
+def _load_illusts(path: str) -> List[Any]:
+    """Читает и разбирает JSON-файл с артами. Выполняется в отдельном потоке."""
+    with open(path, 'r', encoding='utf-8') as f:
+        # JsonDict дает доступ к полям через атрибуты, как у ответов API,
+        # поэтому format_illust одинаково работает и с файлами, и с поиском
+        raw_json = json.load(f, object_hook=JsonDict)
+    if isinstance(raw_json, dict):
+        return raw_json.get('illusts', raw_json)
+    return raw_json
+
+
+class FileSourceCache:
+    """
+    Общий для всех пользователей кэш разобранных файлов-источников.
+
+    Запись привязана к пути и mtime файла: если файл перезаписан, он будет разобран заново.
+    Объем записи в памяти оценивается как размер файла на диске, умноженный на
+    PARSED_SIZE_FACTOR; при превышении бюджета вытесняются файлы, к которым дольше
+    всего не обращались (LRU).
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        # path -> (mtime, size, illusts)
+        self._entries: "OrderedDict[str, Tuple[float, int, List[Any]]]" = OrderedDict()
+        self._current_bytes = 0
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, path: str) -> List[Any]:
+        """
+        Возвращает список постов из файла.
+        Разбор выполняется только при первом обращении или после изменения файла.
+        """
+        mtime = os.path.getmtime(path)
+        illusts = self._lookup(path, mtime)
+        if illusts is not None:
+            self.hits += 1
+            return illusts
+
+        # Не даем нескольким пользователям одновременно разбирать один и тот же файл
+        lock = self._locks.setdefault(path, asyncio.Lock())
+        async with lock:
+            illusts = self._lookup(path, mtime)
+            if illusts is not None:
+                self.hits += 1
+                return illusts
+
+            self.misses += 1
+            size = os.path.getsize(path) * PARSED_SIZE_FACTOR
+            illusts = await asyncio.to_thread(_load_illusts, path)
+            self._store(path, mtime, size, illusts)
+            return illusts
+
+    def invalidate(self, path: str):
+        """Удаляет файл из кэша (например, после удаления источника)."""
+        entry = self._entries.pop(path, None)
+        if entry:
+            self._current_bytes -= entry[1]
+        self._locks.pop(path, None)
+
+    def _lookup(self, path: str, mtime: float) -> Optional[List[Any]]:
+        entry = self._entries.get(path)
+        if entry is None:
+            return None
+        if entry[0] != mtime:
+            # Файл изменился на диске - старая версия больше не нужна
+            self.invalidate(path)
+            return None
+        self._entries.move_to_end(path)
+        return entry[2]
+
+    def _store(self, path: str, mtime: float, size: int, illusts: List[Any]):
+        if size > self.max_bytes:
+            logger.warning(f"Файл {path} (~{size} байт в памяти) больше бюджета кэша, он не будет закэширован.")
+            return
+        while self._entries and self._current_bytes + size > self.max_bytes:
+            evicted_path, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self._current_bytes -= evicted_size
+            self.evictions += 1
+            logger.debug(f"Файл {evicted_path} вытеснен из кэша.")
+        self._entries[path] = (mtime, size, illusts)
+        self._current_bytes += size
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'files': len(self._entries),
+            'bytes': self._current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+        }
+
+
+# Единый кэш для всего бота
+file_source_cache = FileSourceCache(settings.file_cache_max_mb * 1024 * 1024)
+register_metrics('file_source_cache', file_source_cache.stats)
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Optional
+
+from app.core.config import settings
+from app.utils.metrics import register_metrics
+
+logger = logging.getLogger(__name__)
+
+# Ограничение Telegram на фото, отправляемое через sendPhoto
+TELEGRAM_PHOTO_MAX_BYTES = 10 * 1024 * 1024
+# Если после первого прохода файл все еще больше лимита, качество снижается этими шагами
+QUALITY_STEP = 10
+MIN_QUALITY = 50
+
+
+def prepare_for_telegram(src_path: str, dst_path: str, max_side: int, quality: int, fmt: str) -> int:
+    """
+    Уменьшает картинку до max_side по длинной стороне и перекодирует в JPEG/WebP.
+    Выполняется в отдельном процессе. Возвращает размер результата в байтах.
+    """
+    # Импорт здесь: Pillow нужен только рабочим процессам
+    from PIL import Image
+
+    with Image.open(src_path) as img:
+        # Для JPEG декодер сразу уменьшает картинку в 2/4/8 раз - это в разы быстрее полного разбора
+        img.draft('RGB', (max_side, max_side))
+        # У анимаций берется первый кадр
+        img.seek(0)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            rgba = img.convert('RGBA')
+            img = Image.new('RGB', rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel('A'))
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        while True:
+            img.save(dst_path, format=fmt, quality=quality)
+            with open(dst_path, 'rb') as f:
+                size = f.seek(0, 2)
+            if size <= TELEGRAM_PHOTO_MAX_BYTES or quality <= MIN_QUALITY:
+                return size
+            quality -= QUALITY_STEP
+
+
+class ImagePreparer:
+    """
+    Пул процессов для подготовки картинок: декодирование и сжатие больших оригиналов
+    занимают сотни миллисекунд CPU и не должны блокировать event loop бота.
+    """
+
+    def __init__(self, workers: int, max_side: int, quality: int, fmt: str):
+        self.workers = workers
+        self.max_side = max_side
+        self.quality = quality
+        self.format = fmt.upper()
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+        self.prepared = 0
+        self.failed = 0
+        self.pool_restarts = 0
+        self.seconds_total = 0.0
+        self.output_bytes = 0
+
+    @property
+    def extension(self) -> str:
+        return '.webp' if self.format == 'WEBP' else '.jpg'
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: форк процесса с работающим event loop и потоками небезопасен
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    async def prepare(self, src_path: str, dst_path: str) -> bool:
+        """Готовит src_path для отправки в Telegram и пишет результат в dst_path."""
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        try:
+            size = await loop.run_in_executor(
+                executor, prepare_for_telegram,
+                src_path, dst_path, self.max_side, self.quality, self.format
+            )
+        except BrokenProcessPool:
+            # Воркер упал (например, по памяти) - такой пул больше не принимает задачи, создаем новый
+            self.failed += 1
+            if self._executor is executor:
+                self._executor = None
+                self.pool_restarts += 1
+                executor.shutdown(wait=False, cancel_futures=True)
+            logger.error(f"Пул подготовки картинок сломан на {src_path}, будет создан заново.")
+            return False
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"Не удалось подготовить картинку {src_path}: {e}")
+            return False
+        self.prepared += 1
+        self.seconds_total += time.perf_counter() - started
+        self.output_bytes += size
+        return True
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'workers': self.workers,
+            'prepared': self.prepared,
+            'failed': self.failed,
+            'pool_restarts': self.pool_restarts,
+            'avg_ms': self.seconds_total / self.prepared * 1000 if self.prepared else 0.0,
+            'output_bytes': self.output_bytes,
+        }
+
+
+image_preparer = ImagePreparer(
+    workers=settings.image_prep_workers,
+    max_side=settings.image_prep_max_side,
+    quality=settings.image_prep_quality,
+    fmt=settings.image_prep_format,
+)
+register_metrics('image_prep', image_preparer.stats)
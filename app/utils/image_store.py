@@ -0,0 +1,243 @@
+import asyncio
+import contextlib
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+from app.core.config import settings
+from app.database.engine import DATA_DIR
+from app.utils.image_prep import image_preparer
+from app.utils.metrics import register_metrics
+
+logger = logging.getLogger(__name__)
+
+IMAGE_STORE_DIR = os.path.join(DATA_DIR, 'images')
+
+
+def image_key(url: str) -> str:
+    """
+    Имя файла картинки. Адреса оригиналов на i.pximg.net содержат время загрузки
+    и не переиспользуются для другого содержимого, поэтому хэш адреса однозначно
+    определяет содержимое файла. Расширение сохраняем для Telegram.
+    """
+    ext = os.path.splitext(url.rsplit('/', 1)[-1])[1].lower() or '.img'
+    return hashlib.sha256(url.encode('utf-8')).hexdigest() + ext
+
+
+class ImageStore:
+    """
+    Дисковый кэш скачанных с Pixiv картинок с ограничением по суммарному размеру.
+
+    Каждая картинка скачивается один раз: одновременные запросы одного адреса
+    ждут одну загрузку, а повторные берут файл с диска. При превышении бюджета
+    удаляются файлы, к которым дольше всего не обращались (время доступа хранится
+    в mtime файла, поэтому порядок LRU переживает перезапуск бота).
+    Неудачная загрузка или подготовка запоминается на failure_ttl секунд: пока
+    Pixiv недоступен, отправка сразу переходит к следующему способу, не дожидаясь таймаута.
+    Файлы, которые сейчас отправляются в Telegram (pinned), не вытесняются.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, failure_ttl: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.failure_ttl = failure_ttl
+        # имя файла -> размер, от давно использованных к недавним
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._current_bytes = 0
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self._downloads: Dict[str, asyncio.Task] = {}
+        # имя файла -> когда не удалось его получить, от старых к новым
+        self._failures: "OrderedDict[str, float]" = OrderedDict()
+        # имя файла -> сколько отправок его сейчас читает
+        self._pins: Dict[str, int] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.download_errors = 0
+        self.failure_skips = 0
+        self.downloaded_bytes = 0
+        self.evictions = 0
+
+    def _scan(self):
+        """Собирает уже лежащие на диске файлы. Выполняется в отдельном потоке."""
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+            elif entry.name.startswith('.'):
+                # Недокачанный временный файл с прошлого запуска
+                os.remove(entry.path)
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._current_bytes += size
+
+    async def _ensure_loaded(self):
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if not self._loaded:
+                await asyncio.to_thread(self._scan)
+                self._loaded = True
+                logger.info(f"Кэш картинок: {len(self._entries)} файлов, {self._current_bytes} байт.")
+
+    async def get(self, url: str, download: Callable[[str], Awaitable[bytes]]) -> Optional[str]:
+        """
+        Возвращает путь к локальной копии картинки, при необходимости скачав ее через download(url).
+        None - если скачать не удалось.
+        """
+        await self._ensure_loaded()
+        name = image_key(url)
+        return await self._get_or_create(name, lambda: self._download(url, name, download))
+
+    async def get_prepared(self, url: str, download: Callable[[str], Awaitable[bytes]]) -> Optional[str]:
+        """
+        Путь к версии картинки, уменьшенной и пережатой под ограничения Telegram.
+        Оригинал и подготовленная версия хранятся рядом и делят один бюджет.
+        """
+        await self._ensure_loaded()
+        name = image_key(url) + '.tg' + image_preparer.extension
+        if name in self._entries:
+            path = await self._get_or_create(name, None)
+            if path is not None:
+                return path
+            # Файл пропал с диска - запись уже снята, готовим картинку заново
+        original = await self.get(url, download)
+        if original is None:
+            return None
+        return await self._get_or_create(name, lambda: self._prepare(original, name))
+
+    async def _get_or_create(self, name: str, create: Optional[Callable[[], Awaitable[Optional[str]]]]):
+        path = os.path.join(self.directory, name)
+        if name in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(name)
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # Файл удалили снаружи - забываем и создаем заново
+                self._current_bytes -= self._entries.pop(name)
+            else:
+                return path
+        if create is None:
+            return None
+        if self._recently_failed(name):
+            self.failure_skips += 1
+            return None
+
+        task = self._downloads.get(name)
+        if task is None:
+            self.misses += 1
+            task = asyncio.create_task(create())
+            self._downloads[name] = task
+            task.add_done_callback(lambda t: self._finish(name, t))
+        # shield: отмена одного ожидающего не должна прерывать общую загрузку
+        return await asyncio.shield(task)
+
+    @contextlib.contextmanager
+    def pinned(self, paths: Iterable[str]):
+        """Защищает файлы от вытеснения, пока их читает отправка (FSInputFile открывает файл при загрузке)."""
+        names = [os.path.basename(path) for path in paths]
+        for name in names:
+            self._pins[name] = self._pins.get(name, 0) + 1
+        try:
+            yield
+        finally:
+            for name in names:
+                if self._pins[name] == 1:
+                    del self._pins[name]
+                else:
+                    self._pins[name] -= 1
+
+    def _recently_failed(self, name: str) -> bool:
+        now = time.monotonic()
+        # Записи упорядочены по времени - устаревшие снимаем с начала
+        while self._failures and next(iter(self._failures.values())) <= now - self.failure_ttl:
+            self._failures.popitem(last=False)
+        return name in self._failures
+
+    def _finish(self, name: str, task: asyncio.Task):
+        self._downloads.pop(name, None)
+        if task.cancelled():
+            return
+        if task.exception() is not None or task.result() is None:
+            self._failures.pop(name, None)
+            self._failures[name] = time.monotonic()
+
+    async def _download(self, url: str, name: str, download: Callable[[str], Awaitable[bytes]]) -> Optional[str]:
+        try:
+            data = await download(url)
+        except Exception as e:
+            self.download_errors += 1
+            logger.warning(f"Не удалось скачать {url}: {e}")
+            return None
+        path = await asyncio.to_thread(self._write, name, data)
+        self.downloaded_bytes += len(data)
+        self._add(name, len(data))
+        return path
+
+    async def _prepare(self, original: str, name: str) -> Optional[str]:
+        fd, tmp_path = tempfile.mkstemp(prefix='.', dir=self.directory)
+        os.close(fd)
+        if not await image_preparer.prepare(original, tmp_path):
+            os.remove(tmp_path)
+            return None
+        path = os.path.join(self.directory, name)
+        os.replace(tmp_path, path)
+        self._add(name, os.path.getsize(path))
+        return path
+
+    def _write(self, name: str, data: bytes) -> str:
+        # Пишем во временный файл и переименовываем, чтобы никто не прочитал недописанную картинку
+        fd, tmp_path = tempfile.mkstemp(prefix='.', dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        path = os.path.join(self.directory, name)
+        os.replace(tmp_path, path)
+        return path
+
+    def _add(self, name: str, size: int):
+        self._entries[name] = size
+        self._current_bytes += size
+        # Только что скачанный файл и файлы, которые сейчас отправляются, не вытесняем,
+        # даже если бюджет превышен - лишнее освободит одно из следующих добавлений
+        for evicted in list(self._entries):
+            if self._current_bytes <= self.max_bytes:
+                break
+            if evicted == name or evicted in self._pins:
+                continue
+            self._current_bytes -= self._entries.pop(evicted)
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.directory, evicted))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'files': len(self._entries),
+            'bytes': self._current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'in_flight': len(self._downloads),
+            'pinned': len(self._pins),
+            'downloaded_bytes': self.downloaded_bytes,
+            'download_errors': self.download_errors,
+            'recent_failures': len(self._failures),
+            'failure_skips': self.failure_skips,
+            'evictions': self.evictions,
+        }
+
+
+image_store = ImageStore(IMAGE_STORE_DIR, settings.image_store_max_mb * 1024 * 1024,
+                         settings.image_store_failure_ttl)
+register_metrics('image_store', image_store.stats)
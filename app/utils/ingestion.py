@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from aiogram import Bot
+
+from app.database import requests as rq
+from app.database.engine import async_session_factory
+from app.utils.post_store import rebuild_post_store, open_post_store
+
+logger = logging.getLogger(__name__)
+
+# Сколько постов индексируется за одну транзакцию
+BATCH_SIZE = 500
+# Как часто (в секундах) обновлять сообщение с прогрессом, чтобы не упереться в лимиты Telegram
+PROGRESS_INTERVAL = 3.0
+
+# Запущенные задачи индексации: source_id -> task
+_tasks: Dict[int, asyncio.Task] = {}
+
+
+async def _report(bot: Bot, chat_id: Optional[int], message_id: Optional[int], text: str):
+    """Обновляет сообщение с прогрессом у загрузившего файл пользователя."""
+    if chat_id is None or message_id is None:
+        return
+    try:
+        await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+    except Exception:
+        logger.debug("Не удалось обновить сообщение о прогрессе индексации.", exc_info=True)
+
+
+async def ingest_file_source(bot: Bot, source_id: int, path: str, name: str, chat_id: Optional[int] = None):
+    """
+    Конвертирует файл в компактное хранилище постов и раскладывает все его картинки
+    в таблицу source_images, чтобы при оценке следующий арт находился одним запросом к БД.
+    """
+    message_id = None
+    if chat_id is not None:
+        progress_message = await bot.send_message(chat_id, f"Индексирую файл '{name}'...")
+        message_id = progress_message.message_id
+
+    try:
+        # Потоковая конвертация: исходный JSON никогда не загружается в память целиком
+        await rebuild_post_store(path)
+        store = await open_post_store(path)
+        total = len(store)
+
+        async with async_session_factory() as session:
+            await rq.set_source_ingest_status(session, source_id, 'running')
+            await rq.clear_source_images(session, source_id)
+            await session.commit()
+
+            last_report = time.monotonic()
+            for start in range(0, total, BATCH_SIZE):
+                posts = []
+                for post_index in range(start, min(start + BATCH_SIZE, total)):
+                    formatted_art = store.get(post_index)
+                    # Некорректные посты конвертер сохраняет пустыми записями
+                    if formatted_art is not None:
+                        posts.append((post_index, formatted_art))
+                await rq.add_source_images(session, source_id, posts)
+                # Каждая пачка - отдельная транзакция, чтобы не держать блокировку записи надолго
+                await session.commit()
+
+                if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    done = min(start + BATCH_SIZE, total)
+                    await _report(bot, chat_id, message_id,
+                                  f"Индексирую файл '{name}': {done}/{total} постов...")
+
+            await rq.set_source_ingest_status(session, source_id, 'done', posts=total)
+            await session.commit()
+
+        logger.info(f"Файл {path} проиндексирован: {total} постов.")
+        await _report(bot, chat_id, message_id, f"Файл '{name}' проиндексирован: {total} постов. Можно оценивать!")
+
+    except asyncio.CancelledError:
+        logger.info(f"Индексация файла {path} отменена.")
+        raise
+    except Exception:
+        logger.error(f"Ошибка индексации файла {path}", exc_info=True)
+        async with async_session_factory() as session:
+            await rq.set_source_ingest_status(session, source_id, 'failed')
+            await session.commit()
+        await _report(bot, chat_id, message_id,
+                      f"Не удалось проиндексировать файл '{name}'. Оценка будет работать в медленном режиме.")
+
+
+def start_ingestion(bot: Bot, source_id: int, path: str, name: str, chat_id: Optional[int] = None):
+    """Запускает индексацию файла в фоне."""
+    cancel_ingestion(source_id)
+    task = asyncio.create_task(ingest_file_source(bot, source_id, path, name, chat_id))
+    _tasks[source_id] = task
+    task.add_done_callback(lambda t: _tasks.pop(source_id, None) if _tasks.get(source_id) is t else None)
+    return task
+
+
+def cancel_ingestion(source_id: int):
+    """Отменяет индексацию (например, если источник удален)."""
+    task = _tasks.pop(source_id, None)
+    if task and not task.done():
+        task.cancel()
+
+
+async def resume_pending_ingestions(bot: Bot):
+    """Запускает индексацию файлов, которые еще не были (или не до конца) проиндексированы."""
+    async with async_session_factory() as session:
+        sources = await rq.get_sources_pending_ingestion(session)
+    for source in sources:
+        path = source.details.get('path')
+        if path:
+            logger.info(f"Возобновляю индексацию файла {path}")
+            start_ingestion(bot, source.source_id, path, source.name)
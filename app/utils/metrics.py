@@ -0,0 +1,26 @@
+from typing import Callable, Dict, Any
+
+# Реестр поставщиков метрик: имя компонента -> функция, возвращающая словарь счетчиков
+_providers: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+
+def register_metrics(name: str, provider: Callable[[], Dict[str, Any]]):
+    """Регистрирует компонент, счетчики которого попадут в /metrics."""
+    _providers[name] = provider
+
+
+def collect_metrics() -> Dict[str, Dict[str, Any]]:
+    """Собирает текущие значения счетчиков всех зарегистрированных компонентов."""
+    return {name: provider() for name, provider in _providers.items()}
+
+
+def format_metrics() -> str:
+    """Форматирует метрики в текст для отправки в чат."""
+    lines = []
+    for name, values in collect_metrics().items():
+        lines.append(f"<b>{name}</b>")
+        for key, value in values.items():
+            if isinstance(value, float):
+                value = f"{value:.3f}"
+            lines.append(f"  {key}: {value}")
+    return "\n".join(lines) if lines else "Метрики пока не собраны."
@@ -1,11 +1,61 @@
+import asyncio
 import logging
-from typing import Optional, Dict, Any
+import time
+from typing import Optional, Dict, Any, Awaitable, Callable
+
+import aiohttp
 from pixivpy_async import AppPixivAPI
 
 from app.core.config import settings
+from app.utils.metrics import register_metrics
+from app.utils.search_cache import SearchPageCache
 
 logger = logging.getLogger(__name__)
 
+# Без этого Referer i.pximg.net отвечает 403 на запрос оригинала
+PIXIV_IMAGE_REFERER = 'https://app-api.pixiv.net/'
+IMAGE_DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=60, sock_connect=10)
+# Сколько раз выполнять запрос к API: первая попытка и повтор после перелогина
+MAX_API_ATTEMPTS = 2
+# Время жизни токена, если Pixiv его не сообщил, и пауза перед повтором неудачного фонового обновления
+DEFAULT_TOKEN_TTL = 3600
+REFRESH_RETRY_DELAY = 30
+
+
+class TokenBucket:
+    """
+    Глобальный ограничитель скорости: rate токенов в секунду, не больше burst подряд.
+    После ответа Pixiv о превышении лимита выдача токенов приостанавливается целиком.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        # Под замком ожидающие получают токены строго по очереди
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу на seconds и сжигает накопленный запас, чтобы после паузы не было всплеска."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
 
 class PixivClient:
     """
@@ -16,18 +66,141 @@ class PixivClient:
     def __init__(self, refresh_token: str):
         self._refresh_token = refresh_token
         self.api = AppPixivAPI()
+        # Одна и та же страница поиска нужна всем пользователям с таким же запросом
+        self.search_cache = SearchPageCache(
+            ttl=settings.pixiv_search_cache_ttl,
+            stale_ttl=settings.pixiv_search_cache_stale,
+            max_entries=settings.pixiv_search_cache_size,
+        )
+        # Общий пул соединений с keep-alive для API и картинок; создается внутри event loop при первом запросе
+        self._http: Optional[aiohttp.ClientSession] = None
+        self._limiter = TokenBucket(settings.pixiv_rate_per_sec, settings.pixiv_rate_burst)
+        self._semaphore = asyncio.Semaphore(settings.pixiv_max_concurrency)
+        self._timeout = settings.pixiv_request_timeout
+
+        # Вход выполняется в одной задаче, остальные вызывающие ждут ее результата
+        self._login_task: Optional[asyncio.Task] = None
+        # Номер успешного входа: по нему видно, что токен уже обновили, пока запрос выполнялся
+        self._login_generation = 0
+        self._token_expires_at = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
 
-    async def login(self):
-        """Выполняет вход в Pixiv. Должна вызываться один раз при старте бота."""
+        self.logins = 0
+        self.login_failures = 0
+        self.login_waiters = 0
+        self.proactive_refreshes = 0
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.rate_limited = 0
+        self.in_flight = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.duration_total = 0.0
+        self.duration_max = 0.0
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self._http is None or self._http.closed:
+            connector = aiohttp.TCPConnector(limit=settings.pixiv_http_pool_size, keepalive_timeout=60,
+                                             ttl_dns_cache=300)
+            self._http = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self._timeout, sock_connect=10),
+            )
+            # pixivpy_async использует переданную сессию вместо новой на каждый запрос
+            self.api.session = self._http
+        return self._http
+
+    async def _call(self, name: str, request: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Выполняет запрос к API через общий ограничитель: сначала очередь (семафор и токен),
+        затем сам запрос с таймаутом. Время ожидания и выполнения попадает в метрики.
+        """
+        self._session()
+        queued = time.perf_counter()
+        async with self._semaphore:
+            await self._limiter.acquire()
+            waited = time.perf_counter() - queued
+            self.queue_wait_total += waited
+            self.queue_wait_max = max(self.queue_wait_max, waited)
+
+            self.calls += 1
+            self.in_flight += 1
+            started = time.perf_counter()
+            try:
+                result = await asyncio.wait_for(request(), timeout=self._timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise
+            except Exception:
+                self.errors += 1
+                raise
+            finally:
+                self.in_flight -= 1
+                duration = time.perf_counter() - started
+                self.duration_total += duration
+                self.duration_max = max(self.duration_max, duration)
+
+        if self._is_rate_limited(result):
+            self.rate_limited += 1
+            logger.warning(f"Pixiv ответил Rate Limit на {name}, пауза {settings.pixiv_rate_limit_cooldown} с.")
+            self._limiter.pause(settings.pixiv_rate_limit_cooldown)
+        return result
+
+    @staticmethod
+    def _is_rate_limited(result: Any) -> bool:
+        error = result.get('error') if isinstance(result, dict) else None
+        return bool(error) and 'rate limit' in str(error.get('message', '')).lower()
+
+    async def login(self) -> bool:
+        """
+        Выполняет вход в Pixiv. Одновременные вызовы не создают новых запросов к OAuth:
+        все ждут уже идущий вход.
+        """
+        if self._login_task is None or self._login_task.done():
+            self._login_task = asyncio.create_task(self._login())
+        else:
+            self.login_waiters += 1
+        # shield: отмена одного ожидающего не должна прерывать общий вход
+        return await asyncio.shield(self._login_task)
+
+    async def _login(self) -> bool:
         try:
-            await self.api.login(refresh_token=self._refresh_token)
+            self._session()
+            # Pixiv может выдать новый refresh token - pixivpy_async сохраняет его в api.refresh_token
+            token = await self.api.login(refresh_token=self.api.refresh_token or self._refresh_token)
+            expires_in = (token.get('expires_in') or token.get('response', {}).get('expires_in')
+                          if isinstance(token, dict) else None)
+            self._token_expires_at = time.monotonic() + (expires_in or DEFAULT_TOKEN_TTL)
+            self._login_generation += 1
+            self.logins += 1
             logger.info("Успешная аутентификация в Pixiv API.")
             return True
         except Exception:
+            self.login_failures += 1
             logger.error("ОШИБКА АУТЕНТИФИКАЦИИ в Pixiv.", exc_info=True)
             logger.error("Убедитесь, что ваш PIXIV_REFRESH_TOKEN в .env файле действителен и не истек.")
             return False
 
+    async def _relogin(self, seen_generation: int) -> bool:
+        """Перелогин после ошибки запроса, если токен не обновили, пока этот запрос выполнялся."""
+        if self._login_generation != seen_generation:
+            return True
+        return await self.login()
+
+    async def _refresh_loop(self):
+        """Обновляет токен заранее, чтобы ни один пользователь не попал на его истечение."""
+        while True:
+            delay = self._token_expires_at - settings.pixiv_token_refresh_margin - time.monotonic()
+            await asyncio.sleep(max(delay, 0))
+            self.proactive_refreshes += 1
+            if not await self.login():
+                await asyncio.sleep(REFRESH_RETRY_DELAY)
+
+    def start_token_refresh(self):
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
     async def search(self,
                      query: str,
                      search_target: str = 'partial_match_for_tags',
@@ -37,7 +210,21 @@ class PixivClient:
                      ) -> Optional[Dict[str, Any]]:
         """
         Выполняет поиск с корректной фильтрацией по рейтингу.
+        Страницы результатов берутся из общего кэша.
         """
+        key = self.search_cache.make_key(query, search_target, period, rating, offset)
+        return await self.search_cache.get(
+            key, lambda: self._fetch_search(query, search_target, period, rating, offset)
+        )
+
+    async def _fetch_search(self,
+                            query: str,
+                            search_target: str = 'partial_match_for_tags',
+                            period: Optional[str] = None,
+                            rating: Optional[str] = 'safe',
+                            offset: Optional[int] = None
+                            ) -> Optional[Dict[str, Any]]:
+        """Запрашивает страницу поиска у Pixiv в обход кэша."""
         if not self.api.access_token:
             logger.warning("Токен доступа отсутствует, попытка перелогина...")
             if not await self.login():
@@ -47,38 +234,75 @@ class PixivClient:
             f"Выполняю поиск: query='{query}', target='{search_target}', rating='{rating}', offset={offset}"
         )
 
-        try:
-            # Сначала всегда запрашиваем ВСЕ результаты, так как это самый надежный способ
-            json_result = await self.api.search_illust(
-                word=query,
-                search_target=search_target,
-                sort='date_desc',
-                duration=period,
-                offset=offset,
-            )
+        for attempt in range(1, MAX_API_ATTEMPTS + 1):
+            generation = self._login_generation
+            try:
+                # Сначала всегда запрашиваем ВСЕ результаты, так как это самый надежный способ
+                json_result = await self._call('search_illust', lambda: self.api.search_illust(
+                    word=query,
+                    search_target=search_target,
+                    sort='date_desc',
+                    duration=period,
+                    offset=offset,
+                ))
+                break
+            except Exception:
+                if attempt == MAX_API_ATTEMPTS:
+                    logger.error("Ошибка при поиске в Pixiv, попытки исчерпаны.", exc_info=True)
+                    return None
+                logger.warning("Ошибка при поиске в Pixiv. Попытка перелогина...", exc_info=True)
+                if not await self._relogin(generation):
+                    return None
+                logger.info("Перелогин успешен. Повторный поиск...")
 
-            if not json_result or not json_result.illusts:
-                return None
+        if not json_result or not json_result.illusts:
+            return None
 
-            if rating == 'safe':
-                logger.debug("Фильтрую результаты для SFW (x_restrict == 0)")
-                json_result.illusts = [
-                    illust for illust in json_result.illusts if illust.x_restrict == 0
-                ]
-            elif rating == 'r18':
-                logger.debug("Фильтрую результаты для R-18 (x_restrict > 0)")
-                json_result.illusts = [
-                    illust for illust in json_result.illusts if illust.x_restrict > 0
-                ]
+        if rating == 'safe':
+            logger.debug("Фильтрую результаты для SFW (x_restrict == 0)")
+            json_result.illusts = [
+                illust for illust in json_result.illusts if illust.x_restrict == 0
+            ]
+        elif rating == 'r18':
+            logger.debug("Фильтрую результаты для R-18 (x_restrict > 0)")
+            json_result.illusts = [
+                illust for illust in json_result.illusts if illust.x_restrict > 0
+            ]
 
-            return json_result
+        return json_result
 
-        except Exception:
-            logger.warning("Ошибка при поиске в Pixiv. Попытка перелогина...", exc_info=True)
-            if await self.login():
-                logger.info("Перелогин успешен. Повторный поиск...")
-                return await self.search(query, search_target, period, rating, offset)
-            return None
+    async def download_image(self, url: str) -> bytes:
+        """Скачивает картинку с i.pximg.net с нужными Referer и User-Agent (лимит API на CDN не действует)."""
+        headers = {'Referer': PIXIV_IMAGE_REFERER, 'User-Agent': self.api.user_agent}
+        async with self._session().get(url, headers=headers, timeout=IMAGE_DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'logins': self.logins,
+            'login_failures': self.login_failures,
+            'login_waiters': self.login_waiters,
+            'proactive_refreshes': self.proactive_refreshes,
+            'token_ttl_s': max(self._token_expires_at - time.monotonic(), 0.0),
+            'calls': self.calls,
+            'in_flight': self.in_flight,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'rate_limited': self.rate_limited,
+            'queue_wait_ms_avg': self.queue_wait_total / self.calls * 1000 if self.calls else 0.0,
+            'queue_wait_ms_max': self.queue_wait_max * 1000,
+            'call_ms_avg': self.duration_total / self.calls * 1000 if self.calls else 0.0,
+            'call_ms_max': self.duration_max * 1000,
+        }
 
     def format_illust(self, illust: Dict[str, Any]) -> Dict[str, Any]:
         """Приводит данные об иллюстрации к единому формату для нашего бота."""
@@ -104,3 +328,5 @@ class PixivClient:
 
 # Создаем единый экземпляр клиента для всего бота
 pixiv_client = PixivClient(settings.pixiv_refresh_token)
+register_metrics('pixiv_api', pixiv_client.stats)
+register_metrics('pixiv_search_cache', pixiv_client.search_cache.stats)
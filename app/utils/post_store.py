@@ -0,0 +1,281 @@
+import asyncio
+import json
+import logging
+import mmap
+import os
+import struct
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from pixivpy_async.utils import JsonDict
+
+from app.utils.pixiv import pixiv_client
+
+logger = logging.getLogger(__name__)
+
+# Размер блока, которым читается исходный JSON
+CHUNK_SIZE = 1024 * 1024
+# Формат записи в индексе: смещение начала записи (uint64, little-endian)
+_OFFSET = struct.Struct('<Q')
+# Заголовок индекса: сигнатура формата и размер файла записей, для которого построен индекс
+_HEADER = struct.Struct('<8sQ')
+_MAGIC = b'PSTORE01'
+
+POSTS_SUFFIX = '.posts'
+INDEX_SUFFIX = '.idx'
+
+
+def store_paths(path: str) -> Tuple[str, str]:
+    """Пути к файлу записей и к индексу смещений для исходного JSON-файла."""
+    return path + POSTS_SUFFIX, path + INDEX_SUFFIX
+
+
+class _JsonStream:
+    """
+    Потоковый разбор JSON: документ читается блоками, в памяти держится
+    только текущий блок и разбираемое значение.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._decoder = json.JSONDecoder(object_hook=JsonDict)
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        chunk = self._f.read(CHUNK_SIZE)
+        if not chunk:
+            self._eof = True
+            return
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+
+    def peek(self) -> str:
+        """Возвращает следующий значимый символ, не поглощая его ('' в конце файла)."""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buf) or self._eof:
+                return self._buf[self._pos] if self._pos < len(self._buf) else ''
+            self._fill()
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f"Ожидался символ '{char}' в позиции {self._pos}")
+        self._pos += 1
+
+    def value(self) -> Any:
+        """Разбирает очередное JSON-значение, дочитывая файл, пока оно не будет полным."""
+        while True:
+            self.peek()
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # Число на границе блока может оказаться обрезанным - дочитываем и разбираем заново
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def array(self) -> Iterator[Any]:
+        """Перебирает элементы массива по одному."""
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ',':
+                self._pos += 1
+                continue
+            self.expect(']')
+            return
+
+
+def iter_illusts(f) -> Iterator[Any]:
+    """
+    Перебирает посты из файла выгрузки: либо массив верхнего уровня,
+    либо массив под ключом 'illusts'.
+    """
+    stream = _JsonStream(f)
+    first = stream.peek()
+    if first == '[':
+        yield from stream.array()
+        return
+
+    stream.expect('{')
+    while stream.peek() != '}':
+        key = stream.value()
+        stream.expect(':')
+        if key == 'illusts' and stream.peek() == '[':
+            yield from stream.array()
+        else:
+            stream.value()
+        if stream.peek() == ',':
+            stream.expect(',')
+
+
+def has_post_store(path: str) -> bool:
+    """Проверяет, что для файла есть актуальное компактное хранилище."""
+    posts_path, index_path = store_paths(path)
+    try:
+        return os.path.getmtime(index_path) >= os.path.getmtime(path) and os.path.exists(posts_path)
+    except OSError:
+        return False
+
+
+def build_post_store(path: str) -> int:
+    """
+    Конвертирует JSON-выгрузку в файл компактных записей и индекс смещений.
+    Работает потоково, поэтому память не зависит от размера файла.
+    Возвращает количество постов. Выполняется в отдельном потоке.
+    """
+    posts_path, index_path = store_paths(path)
+    count = 0
+    offset = 0
+    with open(path, 'r', encoding='utf-8') as src, \
+            open(posts_path + '.tmp', 'wb') as posts_out, \
+            open(index_path + '.tmp', 'wb') as index_out:
+        # Размер файла записей известен только в конце - заголовок перезаписывается
+        index_out.write(_HEADER.pack(_MAGIC, 0))
+        for illust in iter_illusts(src):
+            try:
+                record = pixiv_client.format_illust(illust)
+            except Exception:
+                # Сохраняем пустую запись, чтобы индексы постов совпадали с исходным файлом
+                logger.warning(f"Некорректный пост #{count} в файле {path}", exc_info=True)
+                record = None
+            data = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            index_out.write(_OFFSET.pack(offset))
+            posts_out.write(data)
+            offset += len(data)
+            count += 1
+        # Последнее смещение - конец последней записи
+        index_out.write(_OFFSET.pack(offset))
+        index_out.seek(0)
+        index_out.write(_HEADER.pack(_MAGIC, offset))
+
+    # Индекс заменяется последним: если процесс упадет между заменами, новый файл записей
+    # не совпадет по размеру со старым индексом, и хранилище будет пересобрано при открытии
+    os.replace(posts_path + '.tmp', posts_path)
+    os.replace(index_path + '.tmp', index_path)
+    logger.info(f"Файл {path} сконвертирован: {count} постов, {offset} байт.")
+    return count
+
+
+class StalePostStore(Exception):
+    """Индекс не соответствует файлу записей (старый формат или прерванная пересборка)."""
+
+
+class PostStore:
+    """Отображенное в память хранилище постов с доступом к любому посту за O(1)."""
+
+    def __init__(self, path: str):
+        posts_path, index_path = store_paths(path)
+        self.mtime = os.path.getmtime(index_path)
+        self._posts_file = open(posts_path, 'rb')
+        self._index_file = open(index_path, 'rb')
+        # mmap не умеет отображать пустые файлы (файл без постов)
+        self._posts = self._map(self._posts_file)
+        self._index = self._map(self._index_file)
+        try:
+            self._check(os.fstat(self._posts_file.fileno()).st_size)
+        except StalePostStore:
+            self.close()
+            raise
+        self._count = (len(self._index) - _HEADER.size) // _OFFSET.size - 1
+
+    @staticmethod
+    def _map(f) -> Optional[mmap.mmap]:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _check(self, posts_size: int):
+        if self._index is None or len(self._index) < _HEADER.size + _OFFSET.size:
+            raise StalePostStore("индекс пуст или обрезан")
+        magic, indexed_size = _HEADER.unpack_from(self._index, 0)
+        if magic != _MAGIC:
+            raise StalePostStore("неизвестный формат индекса")
+        if indexed_size != posts_size:
+            raise StalePostStore(f"индекс построен для {indexed_size} байт записей, в файле {posts_size}")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def get(self, post_index: int) -> Optional[Dict[str, Any]]:
+        """Декодирует только один пост. Возвращает None для некорректных постов."""
+        if not 0 <= post_index < self._count:
+            raise IndexError(post_index)
+        start, = _OFFSET.unpack_from(self._index, _HEADER.size + post_index * _OFFSET.size)
+        end, = _OFFSET.unpack_from(self._index, _HEADER.size + (post_index + 1) * _OFFSET.size)
+        return json.loads(self._posts[start:end])
+
+    def close(self):
+        for mapped in (self._posts, self._index):
+            if mapped is not None:
+                mapped.close()
+        self._posts_file.close()
+        self._index_file.close()
+
+
+# Открытые хранилища: путь исходного файла -> PostStore
+_open_stores: Dict[str, PostStore] = {}
+# Идущие пересборки: путь исходного файла -> задача. Две сборки одного файла писали бы в одни .tmp
+_builds: Dict[str, asyncio.Task] = {}
+
+
+async def rebuild_post_store(path: str) -> int:
+    """Пересобирает хранилище в отдельном потоке; параллельные вызовы ждут одну сборку."""
+    task = _builds.get(path)
+    if task is None:
+        task = _builds[path] = asyncio.ensure_future(asyncio.to_thread(build_post_store, path))
+        task.add_done_callback(lambda t: _builds.pop(path, None) if _builds.get(path) is t else None)
+    return await asyncio.shield(task)
+
+
+async def open_post_store(path: str) -> Optional[PostStore]:
+    """
+    Возвращает открытое хранилище для файла или None, если его еще нет.
+    Хранилище, индекс которого не соответствует файлу записей, пересобирается.
+    """
+    if not has_post_store(path):
+        close_post_store(path)
+        return None
+    store = _open_stores.get(path)
+    if store is not None and store.mtime != os.path.getmtime(store_paths(path)[1]):
+        # Хранилище пересобрано - переоткрываем
+        close_post_store(path)
+        store = None
+    if store is None:
+        try:
+            store = PostStore(path)
+        except StalePostStore as e:
+            logger.warning(f"Хранилище постов файла {path} не согласовано ({e}), пересобираю.")
+            try:
+                await rebuild_post_store(path)
+                store = PostStore(path)
+            except Exception:
+                logger.error(f"Не удалось пересобрать хранилище постов файла {path}", exc_info=True)
+                return None
+        _open_stores[path] = store
+    return store
+
+
+def close_post_store(path: str):
+    store = _open_stores.pop(path, None)
+    if store is not None:
+        store.close()
+
+
+def remove_post_store(path: str):
+    """Закрывает и удаляет файлы хранилища (при удалении источника)."""
+    close_post_store(path)
+    for store_path in store_paths(path):
+        if os.path.exists(store_path):
+            try:
+                os.remove(store_path)
+            except OSError as e:
+                logger.error(f"Ошибка удаления файла {store_path}: {e}")
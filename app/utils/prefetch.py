@@ -0,0 +1,97 @@
+import asyncio
+import logging
+from typing import Any, Dict, Tuple
+
+from app.core.config import settings
+from app.utils.metrics import register_metrics
+from app.utils.pixiv import pixiv_client
+
+logger = logging.getLogger(__name__)
+
+
+class SearchPrefetcher:
+    """
+    Заранее загружает следующую страницу поиска, пока пользователь досматривает текущую.
+    Загруженная страница попадает в общий кэш поиска PixivClient.
+    """
+
+    def __init__(self, threshold: int):
+        # За сколько постов до конца страницы начинать загрузку следующей
+        self.threshold = threshold
+        # (user_id, source_id) -> (offset, task)
+        self._tasks: Dict[Tuple[int, int], Tuple[int, asyncio.Task]] = {}
+
+        self.started = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.awaited = 0
+
+    def maybe_prefetch(self, user_id: int, source_id: int, query_params: Dict[str, Any],
+                       next_offset: int, posts_left: int):
+        """Запускает фоновую загрузку страницы next_offset, если до конца текущей осталось мало постов."""
+        if posts_left > self.threshold:
+            return
+        key = (user_id, source_id)
+        current = self._tasks.get(key)
+        if current and current[0] == next_offset:
+            return
+        self.cancel(user_id, source_id)
+
+        task = asyncio.create_task(self._prefetch(query_params, next_offset))
+        self._tasks[key] = (next_offset, task)
+        task.add_done_callback(lambda t: self._forget(key, t))
+        self.started += 1
+
+    async def _prefetch(self, query_params: Dict[str, Any], offset: int):
+        logger.debug(f"Предзагрузка страницы поиска '{query_params['query']}' offset={offset}")
+        await pixiv_client.search(
+            query=query_params['query'], search_target=query_params['target'],
+            period=query_params['period'], rating=query_params['rating'],
+            offset=offset
+        )
+        self.completed += 1
+
+    def _forget(self, key: Tuple[int, int], task: asyncio.Task):
+        current = self._tasks.get(key)
+        if current and current[1] is task:
+            del self._tasks[key]
+        if not task.cancelled() and task.exception():
+            logger.warning("Ошибка предзагрузки страницы поиска.", exc_info=task.exception())
+
+    async def wait(self, user_id: int, source_id: int, offset: int):
+        """Дожидается уже запущенной предзагрузки нужной страницы, чтобы не запрашивать ее повторно."""
+        current = self._tasks.get((user_id, source_id))
+        if not current or current[0] != offset:
+            return
+        self.awaited += 1
+        try:
+            # shield: отмена ожидающего обработчика не должна отменять саму загрузку
+            await asyncio.shield(current[1])
+        except Exception:
+            # Ошибку уже залогирует _forget, а поиск просто повторится без кэша
+            pass
+
+    def cancel(self, user_id: int, source_id: int = None):
+        """
+        Отменяет предзагрузки пользователя (по одному источнику или по всем).
+        Запрос к Pixiv прерывается, только если эту страницу больше никто не ждет.
+        """
+        keys = [key for key in self._tasks if key[0] == user_id and (source_id is None or key[1] == source_id)]
+        for key in keys:
+            _, task = self._tasks.pop(key)
+            if not task.done():
+                task.cancel()
+                self.cancelled += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'in_flight': len(self._tasks),
+            'started': self.started,
+            'completed': self.completed,
+            'cancelled': self.cancelled,
+            'awaited_by_user': self.awaited,
+        }
+
+
+search_prefetcher = SearchPrefetcher(settings.pixiv_prefetch_threshold)
+register_metrics('pixiv_prefetch', search_prefetcher.stats)
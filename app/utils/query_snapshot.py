@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import weakref
+from typing import Any, Dict
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.database import requests as rq
+from app.database.engine import async_session_factory
+from app.utils.metrics import register_metrics
+from app.utils.pixiv import pixiv_client
+
+logger = logging.getLogger(__name__)
+
+# Pixiv отдает поиск страницами по 30 постов; столько же новых постов добавляется в снимок за раз
+SEARCH_PAGE_SIZE = 30
+# Предел страниц за одно дополнение, если фильтр рейтинга или дубли отбрасывают почти все
+MAX_PAGES_PER_EXTEND = 10
+
+
+class QuerySnapshots:
+    """
+    Снимки выдачи запросов-источников.
+
+    Посты запроса раскладываются в source_images так же, как посты файла, по стабильному
+    номеру поста: фильтр рейтинга и новые арты в начале выдачи (sort=date_desc) больше не
+    сдвигают прогресс пользователя. Снимок дописывается с курсора по мере просмотра,
+    посты, уже попавшие в снимок, повторно не добавляются.
+
+    Дополнение идет в собственной сессии: курсор читается из БД и новая часть снимка
+    фиксируется, пока удерживается блокировка источника, поэтому параллельные
+    дополнения не пишут разные посты под одним номером.
+    """
+
+    def __init__(self, session_pool: async_sessionmaker):
+        self.session_pool = session_pool
+        # Дополнения одного источника выполняются по очереди. Блокировка живет, пока ее кто-то держит
+        # или ждет, и затем сама пропадает из словаря
+        self._locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+        self.extends = 0
+        self.pages_fetched = 0
+        self.posts_added = 0
+        self.duplicates_skipped = 0
+
+    async def extend(self, source_id: int) -> bool:
+        """
+        Дописывает в снимок следующие SEARCH_PAGE_SIZE постов (после фильтрации), запрашивая
+        у Pixiv столько страниц, сколько нужно, и фиксирует их. Возвращает False, если
+        дописать больше нечего. Вызывающий должен перечитать источник, чтобы увидеть новый курсор.
+        """
+        lock = self._locks.get(source_id)
+        if lock is None:
+            lock = self._locks[source_id] = asyncio.Lock()
+        async with lock, self.session_pool() as session:
+            # Курсор берется из БД: предыдущее дополнение могло сдвинуть его, пока мы ждали блокировку
+            source = await rq.get_source_by_id(session, source_id)
+            if source is None:
+                return False
+            cursor = rq.get_query_snapshot_cursor(source)
+            # Запросы к Pixiv идут без открытой транзакции
+            await session.commit()
+            if cursor['exhausted']:
+                return False
+            query_params = source.details
+            offset = cursor['offset']
+            exhausted = failed = False
+            candidates = {}
+
+            for _ in range(MAX_PAGES_PER_EXTEND):
+                response = await pixiv_client.search(
+                    query=query_params['query'], search_target=query_params['target'],
+                    period=query_params['period'], rating=query_params['rating'],
+                    offset=offset
+                )
+                if response is None:
+                    # Ошибка или пустая страница - курсор не двигаем, попробуем в следующий раз
+                    failed = True
+                    break
+                self.pages_fetched += 1
+                offset += SEARCH_PAGE_SIZE
+                for illust in response.illusts:
+                    candidates.setdefault(illust.id, illust)
+                if not response.next_url:
+                    exhausted = True
+                    break
+                if len(candidates) >= SEARCH_PAGE_SIZE:
+                    break
+
+            # Новые арты сдвигают выдачу вниз, поэтому часть постов приходит повторно
+            known = await rq.get_snapshot_pixiv_ids(session, source_id, list(candidates))
+            self.duplicates_skipped += len(known)
+            new_posts = [illust for pixiv_id, illust in candidates.items() if pixiv_id not in known]
+
+            posts = [(cursor['posts'] + i, pixiv_client.format_illust(illust)) for i, illust in enumerate(new_posts)]
+            await rq.add_source_images(session, source_id, posts)
+            if not failed or posts:
+                await rq.set_query_snapshot_cursor(session, source_id, offset,
+                                                   cursor['posts'] + len(posts), exhausted)
+            await session.commit()
+            self.extends += 1
+            self.posts_added += len(posts)
+            logger.debug(f"Снимок запроса '{source.name}': +{len(posts)} постов, offset={offset}, "
+                         f"exhausted={exhausted}")
+            return bool(posts) or not (exhausted or failed)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'extends': self.extends,
+            'pages_fetched': self.pages_fetched,
+            'posts_added': self.posts_added,
+            'duplicates_skipped': self.duplicates_skipped,
+            'locks': len(self._locks),
+        }
+
+
+query_snapshots = QuerySnapshots(async_session_factory)
+register_metrics('query_snapshots', query_snapshots.stats)
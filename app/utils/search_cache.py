@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SearchPageCache:
+    """
+    Общий кэш страниц поиска Pixiv.
+
+    Свежая запись (младше ttl) отдается сразу. Устаревшая, но еще не просроченная
+    (младше ttl + stale_ttl) тоже отдается сразу, а в фоне запускается ее обновление
+    (stale-while-revalidate). Количество записей ограничено, лишние вытесняются по LRU.
+    Одновременные промахи по одному ключу ждут одну загрузку, а не запрашивают Pixiv каждый сам.
+    Если все ожидающие загрузку отменены (например, предзагрузка после остановки оценки), отменяется и она.
+    """
+
+    def __init__(self, ttl: float, stale_ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        # key -> (время загрузки, страница)
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._refreshing: Dict[Hashable, asyncio.Task] = {}
+        # Идущие загрузки по промахам: key -> задача, которую ждут все запросившие этот ключ
+        self._loading: Dict[Hashable, asyncio.Task] = {}
+        # key -> сколько вызовов get сейчас ждут загрузку
+        self._waiters: Dict[Hashable, int] = {}
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.cancelled_loads = 0
+        self.refreshes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(query: str, search_target: str, period: Optional[str], rating: Optional[str],
+                 offset: Optional[int]) -> Tuple:
+        """Нормализует параметры поиска, чтобы одинаковые запросы попадали в одну запись."""
+        # Регистр не трогаем: операторы вроде OR в запросе чувствительны к нему
+        return (
+            ' '.join(query.split()),
+            search_target,
+            period if period not in (None, 'all') else None,
+            rating or 'all',
+            offset or 0,
+        )
+
+    async def get(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Возвращает страницу из кэша или загружает ее через fetch()."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+            if age < self.ttl:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[1]
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._entries.move_to_end(key)
+                self._schedule_refresh(key, fetch)
+                return entry[1]
+            del self._entries[key]
+
+        task = self._loading.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.create_task(self._load(key, fetch))
+            self._loading[key] = task
+            task.add_done_callback(lambda t: self._forget_load(key, t))
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            # shield: отмена одного ожидающего не должна отменять загрузку для остальных
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # Это был последний ожидающий - результат никому не нужен, запрос к Pixiv прерываем
+            if self._waiters[key] == 1 and not task.done():
+                task.cancel()
+                # Новый запрос того же ключа не должен ждать отменяемую загрузку
+                self._forget_load(key, task)
+                self.cancelled_loads += 1
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    def _forget_load(self, key: Hashable, task: asyncio.Task):
+        if self._loading.get(key) is task:
+            del self._loading[key]
+
+    async def _load(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        value = await fetch()
+        self._store(key, value)
+        return value
+
+    def _schedule_refresh(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]):
+        if key in self._refreshing:
+            return
+        task = asyncio.create_task(self._refresh(key, fetch))
+        self._refreshing[key] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(key, None))
+
+    async def _refresh(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]):
+        self.refreshes += 1
+        try:
+            self._store(key, await fetch())
+        except Exception:
+            logger.warning(f"Не удалось обновить страницу поиска {key} в фоне.", exc_info=True)
+
+    def _store(self, key: Hashable, value: Any):
+        # Ошибки и пустые ответы не кэшируем, чтобы следующий запрос попробовал снова
+        if value is None:
+            return
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.stale_hits + self.misses
+        return {
+            'pages': len(self._entries),
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'loading': len(self._loading),
+            'cancelled_loads': self.cancelled_loads,
+            'hit_rate': (self.hits + self.stale_hits) / total if total else 0.0,
+            'background_refreshes': self.refreshes,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,110 @@
+"""
+Пропускная способность подготовки картинок для Telegram и задержка event loop во время нее.
+
+Сравниваются три режима:
+  * inline - prepare_for_telegram прямо в event loop (как если бы Pillow звали из хендлера);
+  * thread - asyncio.to_thread (Pillow частично отпускает GIL);
+  * pool   - ImagePreparer, пул процессов из app.utils.image_prep.
+
+Запуск из корня репозитория:
+    python -m benchmarks.image_prep_throughput --images 24 --size 4000x6000 --workers 4
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+# Настройки бота обязательны при импорте app.*, для замера хватит заглушек
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+os.environ.setdefault("ADMIN_PASSWORD", "benchmark")
+os.environ.setdefault("PIXIV_REFRESH_TOKEN", "benchmark")
+
+from PIL import Image, ImageDraw
+
+from app.utils.image_prep import ImagePreparer, prepare_for_telegram
+
+MAX_SIDE = 2560
+QUALITY = 87
+
+
+def make_originals(directory: str, count: int, width: int, height: int) -> list:
+    """Рисует крупные PNG/JPEG, похожие на оригиналы с Pixiv (градиент и шум, плохо сжимаются)."""
+    paths = []
+    noise = Image.effect_noise((width, height), 64).convert('RGB')
+    for n in range(count):
+        img = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+        img = Image.blend(img, noise, 0.3 + 0.02 * n)
+        ImageDraw.Draw(img).ellipse((n * 50, n * 50, width // 2, height // 2), outline=(255, 0, 0), width=25)
+        ext = 'png' if n % 2 else 'jpg'
+        path = os.path.join(directory, f"original_{n}.{ext}")
+        img.save(path, quality=95)
+        paths.append(path)
+    return paths
+
+
+async def loop_lag(stop: asyncio.Event, interval: float = 0.01) -> float:
+    """Максимальная задержка, с которой просыпается корутина с тиком interval, - мера блокировки loop."""
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - started - interval)
+    return worst
+
+
+async def run_mode(name: str, originals: list, out_dir: str, workers: int):
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(loop_lag(stop))
+    await asyncio.sleep(0.05)
+
+    preparer = ImagePreparer(workers=workers, max_side=MAX_SIDE, quality=QUALITY, fmt='JPEG')
+    if name == 'pool':
+        # Запуск процессов не относится к пропускной способности - прогреваем заранее
+        await asyncio.gather(*[preparer.prepare(originals[0], os.path.join(out_dir, f"warmup_{n}.jpg"))
+                               for n in range(workers)])
+
+    started = time.perf_counter()
+    outputs = [os.path.join(out_dir, f"{name}_{n}.jpg") for n in range(len(originals))]
+    if name == 'inline':
+        for src, dst in zip(originals, outputs):
+            prepare_for_telegram(src, dst, MAX_SIDE, QUALITY, 'JPEG')
+            await asyncio.sleep(0)
+    elif name == 'thread':
+        semaphore = asyncio.Semaphore(workers)
+
+        async def one(src, dst):
+            async with semaphore:
+                await asyncio.to_thread(prepare_for_telegram, src, dst, MAX_SIDE, QUALITY, 'JPEG')
+        await asyncio.gather(*[one(src, dst) for src, dst in zip(originals, outputs)])
+    else:
+        await asyncio.gather(*[preparer.prepare(src, dst) for src, dst in zip(originals, outputs)])
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    worst_lag = await lag_task
+    preparer.shutdown()
+
+    in_mb = sum(os.path.getsize(p) for p in originals) / 2 ** 20
+    out_mb = sum(os.path.getsize(p) for p in outputs) / 2 ** 20
+    print(f"{name:7s} {len(originals) / elapsed:7.2f} img/s  total={elapsed:6.2f} s  "
+          f"max loop lag={worst_lag * 1000:8.1f} ms  {in_mb:.1f} MB -> {out_mb:.1f} MB")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=24, help="сколько оригиналов подготовить")
+    parser.add_argument('--size', default='4000x6000', help="размер оригиналов, ШxВ")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2, help="процессов/потоков")
+    args = parser.parse_args()
+    width, height = map(int, args.size.lower().split('x'))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"Готовлю {args.images} оригиналов {width}x{height}...")
+        originals = make_originals(tmp, args.images, width, height)
+        for mode in ('inline', 'thread', 'pool'):
+            await run_mode(mode, originals, tmp, args.workers)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
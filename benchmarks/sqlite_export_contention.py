@@ -0,0 +1,128 @@
+"""
+Замер задержки записи оценок во время полного экспорта.
+
+Сравниваются два режима:
+  * default - один движок с настройками SQLite по умолчанию (rollback journal);
+  * profile - профиль из app.database.engine (WAL, pragmas) и отдельный пул для чтения.
+
+Запуск из корня репозитория:
+    python -m benchmarks.sqlite_export_contention --ratings 200000 --writes 300
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+# Настройки бота обязательны при импорте app.*, для замера хватит заглушек
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+os.environ.setdefault("ADMIN_PASSWORD", "benchmark")
+os.environ.setdefault("PIXIV_REFRESH_TOKEN", "benchmark")
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from app.database.engine import make_engine
+from app.database.models import Base, User, Artwork, Source, Rating
+
+USERS = 50
+CHUNK = 5000
+
+
+async def populate(engine, ratings: int):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(insert(User), [{'user_id': u, 'username': f'user{u}'} for u in range(USERS)])
+        await conn.execute(insert(Source), [{'source_type': 'file', 'name': 'bench', 'details': {}}])
+        artworks = ratings // USERS + 1
+        for start in range(0, artworks, CHUNK):
+            await conn.execute(insert(Artwork), [
+                {'pixiv_id': i, 'image_index': 0, 'title': f'art {i}', 'author': 'author', 'url': 'url'}
+                for i in range(start, min(start + CHUNK, artworks))
+            ])
+        rows = [{'user_id': n % USERS, 'artwork_id': n // USERS + 1, 'source_id': 1, 'score': n % 10 + 1}
+                for n in range(ratings)]
+        for start in range(0, len(rows), CHUNK):
+            await conn.execute(insert(Rating), rows[start:start + CHUNK])
+
+
+async def export_loop(session_factory, stop: asyncio.Event) -> int:
+    """Крутит полный экспорт (как export_all), пока идут записи."""
+    exports = 0
+    stmt = (
+        select(Rating.user_id, User.username, Artwork.pixiv_id, Artwork.title, Rating.score, Rating.created_at)
+        .join(User, Rating.user_id == User.user_id)
+        .join(Artwork, Rating.artwork_id == Artwork.id)
+        .order_by(Rating.user_id, Rating.created_at)
+    )
+    while not stop.is_set():
+        async with session_factory() as session:
+            result = await session.stream(stmt)
+            async for _ in result:
+                pass
+        exports += 1
+    return exports
+
+
+async def write_loop(session_factory, writes: int) -> list:
+    """Делает одиночные оценки с commit, как обработчик кнопки, и замеряет задержку каждой."""
+    latencies = []
+    for n in range(writes):
+        started = time.perf_counter()
+        try:
+            async with session_factory() as session:
+                session.add(Rating(user_id=n % USERS, artwork_id=1_000_000 + n, source_id=1, score=5))
+                await session.commit()
+            latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            latencies.append(float('inf'))
+            print(f"  запись #{n} не удалась: {e.__class__.__name__}")
+        await asyncio.sleep(0.005)
+    return latencies
+
+
+async def run_scenario(name: str, write_engine, read_engine, ratings: int, writes: int):
+    await populate(write_engine, ratings)
+    write_factory = async_sessionmaker(write_engine, expire_on_commit=False)
+    read_factory = async_sessionmaker(read_engine, expire_on_commit=False)
+
+    stop = asyncio.Event()
+    exporter = asyncio.create_task(export_loop(read_factory, stop))
+    await asyncio.sleep(0.2)
+    latencies = await write_loop(write_factory, writes)
+    stop.set()
+    exports = await exporter
+
+    finite = sorted(lat for lat in latencies if lat != float('inf'))
+    failed = len(latencies) - len(finite)
+    if finite:
+        p95 = finite[min(len(finite) - 1, int(len(finite) * 0.95))]
+        print(f"{name:8s} p50={statistics.median(finite) * 1000:8.2f} ms  p95={p95 * 1000:8.2f} ms  "
+              f"max={finite[-1] * 1000:8.2f} ms  failed={failed}  exports={exports}")
+    else:
+        print(f"{name:8s} все {failed} записей не удались, exports={exports}")
+
+    await write_engine.dispose()
+    if read_engine is not write_engine:
+        await read_engine.dispose()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ratings', type=int, default=200_000, help="сколько оценок в таблице")
+    parser.add_argument('--writes', type=int, default=300, help="сколько оценок записать во время экспорта")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite+aiosqlite:///{os.path.join(tmp, 'default.db')}"
+        default_engine = create_async_engine(url)
+        await run_scenario('default', default_engine, default_engine, args.ratings, args.writes)
+
+        url = f"sqlite+aiosqlite:///{os.path.join(tmp, 'profile.db')}"
+        await run_scenario('profile', make_engine(url), make_engine(url, read_only=True),
+                           args.ratings, args.writes)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
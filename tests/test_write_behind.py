@@ -0,0 +1,69 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+
+# Настройки бота обязательны при импорте app.*, для теста хватит заглушек
+os.environ.setdefault("BOT_TOKEN", "0:test")
+os.environ.setdefault("ADMIN_PASSWORD", "test")
+os.environ.setdefault("PIXIV_REFRESH_TOKEN", "test")
+
+from sqlalchemy import event, func, insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.database.engine import make_engine
+from app.database.models import Artwork, ArtworkScore, Base, Rating, Source, User, UserProgress
+from app.database.write_behind import WriteBehindBuffer
+
+# Лимит параметров в запросе у стандартной сборки SQLite
+SQLITE_MAX_VARIABLES = 32766
+RATINGS = 12_000
+PROGRESS = 9_000
+
+
+async def _flush_more_than_variable_limit(path: str):
+    engine = make_engine(f"sqlite+aiosqlite:///{path}")
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _limit_variables(dbapi_connection, connection_record):
+        # Сборки SQLite различаются лимитом, тест фиксирует стандартный
+        dbapi_connection.driver_connection._conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, SQLITE_MAX_VARIABLES)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(insert(User), [{'user_id': user_id} for user_id in range(1, PROGRESS + 1)])
+        await conn.execute(insert(Source), [{'source_id': 1, 'source_type': 'file', 'name': 'test'}])
+        await conn.execute(insert(Artwork), [
+            {'id': artwork_id, 'pixiv_id': artwork_id, 'image_index': 0} for artwork_id in range(1, RATINGS + 1)
+        ])
+
+    session_pool = async_sessionmaker(engine, expire_on_commit=False)
+    buffer = WriteBehindBuffer(session_pool, enabled=True, flush_interval=60, max_batch=10_000)
+    for artwork_id in range(1, RATINGS + 1):
+        buffer.add_rating(1, artwork_id, 1, artwork_id % 5 + 1)
+    for user_id in range(1, PROGRESS + 1):
+        buffer.update_progress(user_id, 1, user_id, 0)
+
+    # Один сброс пишет не больше max_batch записей каждого вида
+    await buffer.flush()
+    assert buffer.stats()['pending_ratings'] == RATINGS - buffer.max_batch
+    assert buffer.stats()['pending_progress'] == 0
+
+    buffer.start()
+    await buffer.stop()
+    stats = buffer.stats()
+    assert stats['failed_flushes'] == 0
+    assert stats['pending_ratings'] == 0
+    assert stats['flushed_ratings'] == RATINGS
+
+    async with session_pool() as session:
+        assert await session.scalar(select(func.count()).select_from(Rating)) == RATINGS
+        assert await session.scalar(select(func.count()).select_from(UserProgress)) == PROGRESS
+        assert await session.scalar(select(func.count()).select_from(ArtworkScore)) == RATINGS
+    await engine.dispose()
+
+
+def test_flush_more_rows_than_variable_limit():
+    assert RATINGS * 4 > SQLITE_MAX_VARIABLES
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(_flush_more_than_variable_limit(os.path.join(directory, "test.db")))